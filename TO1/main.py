@@ -4,16 +4,28 @@ import math
 import matplotlib.pyplot as plt
 import time
 import random
+import heapq
+import hashlib
+import inspect
+import functools
+import itertools
+import json
+import sqlite3
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from collections import deque
 from random import randint
+from scipy import sparse
+from scipy import stats
 from scipy.optimize import curve_fit
+from scipy.spatial import cKDTree
 COST_WEIGHT = 6
+TOUR_DTYPE = np.int32
 
 
 class Node:
-    id = int
-    x = float
-    y = float
-    gain = float
+    __slots__ = ("id", "x", "y", "gain")
 
     def __init__(self, id, x, y, gain=0):
         self.id = id
@@ -22,54 +34,255 @@ class Node:
         self.gain = gain
 
 
-def read_positions(path):
-    nodes = []
-    file = np.loadtxt(path, delimiter=" ", skiprows=6)
-    for line in file:
-        node = Node(line[0], line[1], line[2])
-        nodes.append(node)
-    return nodes
+class Instance:
+    def __init__(self, id, x, y, gain):
+        self.id = np.ascontiguousarray(id, dtype=np.int32)
+        self.x = np.ascontiguousarray(x, dtype=np.float64)
+        self.y = np.ascontiguousarray(y, dtype=np.float64)
+        self.gain = np.ascontiguousarray(gain, dtype=np.float64)
+        differences_x = self.x[:, np.newaxis] - self.x[np.newaxis, :]
+        differences_y = self.y[:, np.newaxis] - self.y[np.newaxis, :]
+        self.costs = np.sqrt(differences_x ** 2 + differences_y ** 2) * COST_WEIGHT
+        self.candidates = {}
 
+    def __len__(self):
+        return len(self.id)
 
-def read_gains(nodes, path):
-    file = np.loadtxt(path, delimiter=" ", skiprows=6)
-    for i, line in enumerate(file.tolist()):
-        nodes[i].gain = line[1]
-    return nodes
+    def node(self, index):
+        return Node(int(self.id[index]), float(self.x[index]), float(self.y[index]), float(self.gain[index]))
 
+    def nodes(self, indices=None):
+        if indices is None:
+            indices = range(len(self))
+        return [self.node(index) for index in indices]
 
-def read_data(path):
-    positions_file_path = os.path.join(path, "kroA100.tsp")
-    gain_file_path = os.path.join(path, "kroB100.tsp")
-    nodes = read_positions(positions_file_path)
-    nodes = read_gains(nodes, gain_file_path)
-    return nodes
+    def candidate_lists(self, size):
+        if size not in self.candidates:
+            points = np.column_stack((self.x, self.y))
+            _, neighbours = cKDTree(points).query(points, k=min(size + 1, len(self)))
+            # drop every node from its own list, even when another node shares its position
+            is_self = neighbours == np.arange(len(self))[:, np.newaxis]
+            neighbours = np.take_along_axis(neighbours, np.argsort(is_self, axis=1, kind="stable"), axis=1)
+            self.candidates[size] = neighbours[:, :size].astype(TOUR_DTYPE)
+        return self.candidates[size]
 
 
-def distance(node1, node2):
-    return math.sqrt(pow(node1.x - node2.x, 2) + pow(node1.y - node2.y, 2))
+def read_positions(path):
+    file = np.loadtxt(path, delimiter=" ", skiprows=6)
+    return file[:, 0], file[:, 1], file[:, 2]
 
 
-def find_nearest_neighbour(current_node, available_nodes):
-    best_node = None
-    best_node_result = None
-    for node in available_nodes:
-        cost = distance(current_node, node) * COST_WEIGHT
-        node_result = node.gain - cost
-        if best_node is None or node_result > best_node_result:
-            best_node = node
-            best_node_result = node_result
-    return best_node, best_node_result
+def read_gains(path):
+    file = np.loadtxt(path, delimiter=" ", skiprows=6)
+    return file[:, 1]
 
 
-def nearest_neighbour(nodes, starting_node_index=0):
+def read_data(path):
+    positions_file_path = os.path.join(path, "kroA100.tsp")
+    gain_file_path = os.path.join(path, "kroB100.tsp")
+    ids, x, y = read_positions(positions_file_path)
+    gains = read_gains(gain_file_path)
+    return Instance(ids, x, y, gains)
+
+
+class SharedInstance:
+    # publishes the instance arrays, cost matrix and computed candidate lists in one shared memory block;
+    # workers attach to it by name instead of unpickling a copy
+    def __init__(self, instance):
+        arrays = {"id": instance.id, "x": instance.x, "y": instance.y, "gain": instance.gain, "costs": instance.costs}
+        for size, candidates in instance.candidates.items():
+            arrays["candidates", size] = candidates
+        self.layout = []
+        offset = 0
+        for key, array in arrays.items():
+            self.layout.append((key, array.dtype.str, array.shape, offset))
+            offset += -(-array.nbytes // 64) * 64
+        self.memory = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        for (key, dtype, shape, offset) in self.layout:
+            np.ndarray(shape, dtype, buffer=self.memory.buf, offset=offset)[...] = arrays[key]
+
+    @property
+    def handle(self):
+        return self.memory.name, self.layout
+
+    def close(self):
+        self.memory.close()
+        self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def attach_instance(handle):
+    name, layout = handle
+    memory = shared_memory.SharedMemory(name=name)
+    instance = Instance.__new__(Instance)
+    instance.candidates = {}
+    instance.memory = memory
+    for (key, dtype, shape, offset) in layout:
+        array = np.ndarray(shape, dtype, buffer=memory.buf, offset=offset)
+        array.flags.writeable = False
+        if isinstance(key, tuple):
+            instance.candidates[key[1]] = array
+        else:
+            setattr(instance, key, array)
+    return instance
+
+
+class Checkpoint:
+    # state of a long run saved to one .npz file at most every interval seconds, together with the state
+    # of the random module; written under a temporary name and renamed like the lab 2 cache entries
+    def __init__(self, path, interval=60):
+        self.path = path
+        self.interval = interval
+        self.last_save = time.time()
+
+    def due(self):
+        return time.time() - self.last_save >= self.interval
+
+    def save(self, **state):
+        version, internal_state, gauss_next = random.getstate()
+        temporary_path = self.path + ".tmp.npz"
+        np.savez(temporary_path, random_version=version, random_state=np.array(internal_state, dtype=np.uint32),
+                 random_gauss=np.nan if gauss_next is None else gauss_next, **state)
+        os.replace(temporary_path, self.path)
+        self.last_save = time.time()
+
+    def load(self):
+        # returns the saved arrays and restores the random module, or None when there is no checkpoint
+        if not os.path.exists(self.path):
+            return None
+        with np.load(self.path) as data:
+            state = {key: data[key] for key in data.files}
+        gauss_next = float(state.pop("random_gauss"))
+        random.setstate((int(state.pop("random_version")), tuple(int(value) for value in state.pop("random_state")),
+                         None if math.isnan(gauss_next) else gauss_next))
+        self.last_save = time.time()
+        return state
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Tour:
+    def __init__(self, size, nodes=()):
+        self.order = np.empty(size, dtype=TOUR_DTYPE)
+        self.position = np.full(size, -1, dtype=TOUR_DTYPE)
+        self.used = np.zeros(size, dtype=bool)
+        self.length = len(nodes)
+        self.order[:self.length] = nodes
+        self.update_positions(0, self.length)
+        self.used[self.nodes] = True
+        # while journal is a list every change records the call that undoes it
+        self.journal = None
+
+    def __len__(self):
+        return self.length
+
+    @property
+    def nodes(self):
+        return self.order[:self.length]
+
+    def free_nodes(self):
+        return np.flatnonzero(~self.used)
+
+    def copy(self):
+        tour = Tour.__new__(Tour)
+        tour.order = self.order.copy()
+        tour.position = self.position.copy()
+        tour.used = self.used.copy()
+        tour.length = self.length
+        tour.journal = None
+        return tour
+
+    def update_positions(self, start, end):
+        self.position[self.order[start:end]] = np.arange(start, end)
+
+    def insert(self, position, node):
+        self.order[position + 1:self.length + 1] = self.order[position:self.length]
+        self.order[position] = node
+        self.length += 1
+        self.used[node] = True
+        self.update_positions(position, self.length)
+        if self.journal is not None:
+            self.journal.append((self.remove, (position,)))
+
+    def remove(self, position):
+        node = self.order[position]
+        self.order[position:self.length - 1] = self.order[position + 1:self.length]
+        self.length -= 1
+        self.used[node] = False
+        self.position[node] = -1
+        self.update_positions(position, self.length)
+        if self.journal is not None:
+            self.journal.append((self.insert, (position, node)))
+        return node
+
+    def swap(self, i, j):
+        self.order[i], self.order[j] = self.order[j], self.order[i]
+        self.position[self.order[i]] = i
+        self.position[self.order[j]] = j
+        if self.journal is not None:
+            self.journal.append((self.swap, (i, j)))
+
+    def reverse(self, i, j):
+        self.order[i:j + 1] = self.order[i:j + 1][::-1]
+        self.update_positions(i, j + 1)
+        if self.journal is not None:
+            self.journal.append((self.reverse, (i, j)))
+
+    def rollback(self):
+        journal, self.journal = self.journal, None
+        while journal:
+            undo, arguments = journal.pop()
+            undo(*arguments)
+        self.journal = journal
+
+    def successor(self, node):
+        return self.order[(self.position[node] + 1) % self.length]
+
+    def predecessor(self, node):
+        return self.order[(self.position[node] - 1) % self.length]
+
+    def has_edge(self, start, end):
+        if not (self.used[start] and self.used[end]):
+            return False
+        return self.successor(start) == end or self.predecessor(start) == end
+
+
+def index_of(cycle, node):
+    return int(np.flatnonzero(cycle == node)[0])
+
+
+def free_nodes(instance, cycle):
+    return np.setdiff1d(np.arange(len(instance)), cycle).tolist()
+
+
+def close_cycle(cycle):
+    return np.append(cycle, cycle[:1])
+
+
+def find_nearest_neighbour(instance, current_node, available_nodes):
+    if len(available_nodes) == 0:
+        return None, None
+    node_results = instance.gain[available_nodes] - instance.costs[current_node, available_nodes]
+    best = int(np.argmax(node_results))
+    return available_nodes[best], node_results[best]
+
+
+def nearest_neighbour(instance, starting_node_index=0):
+    nodes = list(range(len(instance)))
     current_node = nodes[starting_node_index]
     cycle = [current_node]
-    cycle_values = [current_node.gain]
+    cycle_values = [instance.gain[current_node]]
     nodes.remove(current_node)
 
     while True:
-        next_node, next_node_result = find_nearest_neighbour(current_node, nodes)
+        next_node, next_node_result = find_nearest_neighbour(instance, current_node, nodes)
 
         if next_node is None or next_node_result < 0:
             break
@@ -79,125 +292,169 @@ def nearest_neighbour(nodes, starting_node_index=0):
         cycle_values.append(next_node_result)
         current_node = next_node
 
-    cycle_values.append(-distance(cycle[0], cycle[-1]) * COST_WEIGHT)
-    cycle.append(cycle[0])
+    cycle_values.append(-instance.costs[cycle[0], cycle[-1]])
     final_value = sum(cycle_values)
-    return cycle, final_value
+    return np.array(cycle, dtype=TOUR_DTYPE), final_value
+
 
+def insertion_results(instance, nodes, edge_starts, edge_ends):
+    costs = instance.costs
+    cost = costs[np.ix_(edge_starts, nodes)] + costs[np.ix_(edge_ends, nodes)]
+    return instance.gain[nodes] + costs[edge_starts, edge_ends][:, np.newaxis] - cost
 
-def find_nearest_expansion(available_nodes, cycle, random_expansion=False):
+
+def find_nearest_expansion(instance, available_nodes, cycle, random_expansion=False):
     best_node = None
     best_node_result = -float("inf")
     best_edge = None
+    costs = instance.costs
 
     if random_expansion:
-        i = random.randint(0, len(cycle) - 2)
+        i = random.randint(0, len(cycle) - 1)
         j = random.randint(0, len(available_nodes)-1)
-        cost = (distance(cycle[i], available_nodes[j]) + distance(cycle[i + 1], available_nodes[j])) * COST_WEIGHT
-        node_result = available_nodes[j].gain + distance(cycle[i], cycle[i + 1]) * COST_WEIGHT - cost
-        return available_nodes[j], node_result, (cycle[i], cycle[i + 1])
-
-    for i in range(len(cycle) - 1):
-        for node in available_nodes:
-            cost = (distance(cycle[i], node) + distance(cycle[i + 1], node)) * COST_WEIGHT
-            node_result = node.gain + distance(cycle[i], cycle[i + 1]) * COST_WEIGHT - cost
-            if best_node is None or node_result > best_node_result:
-                best_node = node
-                best_node_result = node_result
-                best_edge = (cycle[i], cycle[i + 1])
+        edge = (cycle[i], cycle[(i + 1) % len(cycle)])
+        cost = costs[edge[0], available_nodes[j]] + costs[edge[1], available_nodes[j]]
+        node_result = instance.gain[available_nodes[j]] + costs[edge] - cost
+        return available_nodes[j], node_result, edge
+
+    if len(available_nodes) == 0:
+        return best_node, best_node_result, best_edge
+
+    # rows are cycle edges, columns are free nodes; argmax keeps the first best pair like the scan did
+    available_nodes = np.asarray(available_nodes)
+    edge_starts, edge_ends = cycle, np.roll(cycle, -1)
+    node_results = insertion_results(instance, available_nodes, edge_starts, edge_ends)
+    edge_index, node_index = np.unravel_index(np.argmax(node_results), node_results.shape)
+
+    best_node = int(available_nodes[node_index])
+    best_node_result = node_results[edge_index, node_index]
+    best_edge = (edge_starts[edge_index], edge_ends[edge_index])
     return best_node, best_node_result, best_edge
 
 
-def cycle_expansion(nodes, starting_node_index=0):
+class InsertionCache:
+    def __init__(self, instance, tour, k=1):
+        self.instance = instance
+        self.tour = tour
+        self.k = k
+        # k best insertion edges of every free node (identified by their first node), best first
+        self.top_starts = np.full((len(instance), k), -1, dtype=TOUR_DTYPE)
+        self.top_results = np.full((len(instance), k), -float("inf"))
+        self.version = np.zeros(len(instance), dtype=np.int64)
+        self.heap = []
+        self.rescan(tour.free_nodes())
+
+    def successor(self, node):
+        return self.tour.order[(self.tour.position[node] + 1) % len(self.tour)]
+
+    def priority(self, nodes):
+        return self.top_results[nodes, 0]
+
+    def push(self, nodes):
+        self.version[nodes] += 1
+        priorities = self.priority(nodes)
+        for node, priority, version in zip(nodes.tolist(), priorities.tolist(), self.version[nodes].tolist()):
+            if priority > -float("inf"):
+                heapq.heappush(self.heap, (-priority, node, version))
+
+    def rescan(self, nodes):
+        if len(nodes) == 0:
+            return
+        edge_starts = self.tour.nodes
+        node_results = insertion_results(self.instance, nodes, edge_starts, np.roll(edge_starts, -1))
+        best_edges = np.argsort(-node_results, axis=0, kind="stable")[:self.k]
+        self.top_starts[nodes, :len(best_edges)] = edge_starts[best_edges].T
+        self.top_results[nodes, :len(best_edges)] = np.take_along_axis(node_results, best_edges, axis=0).T
+        self.push(nodes)
+
+    def best(self):
+        while self.heap:
+            _, node, version = self.heap[0]
+            if not self.tour.used[node] and version == self.version[node]:
+                start = self.top_starts[node, 0]
+                return node, self.top_results[node, 0], (start, self.successor(start))
+            heapq.heappop(self.heap)
+        return None, -float("inf"), None
+
+    def insert(self, node):
+        start = self.top_starts[node, 0]
+        end = self.successor(start)
+        self.tour.insert(self.tour.position[start] + 1, node)
+
+        nodes = self.tour.free_nodes()
+        broken = (self.top_starts[nodes] == start).any(axis=1)
+        self.rescan(nodes[broken])
+
+        # every other cached edge still exists, so only the two new edges can enter the top k
+        nodes = nodes[~broken]
+        new_results = insertion_results(self.instance, nodes, np.array([start, node]), np.array([node, end]))
+        merged_results = np.concatenate((self.top_results[nodes], new_results.T), axis=1)
+        merged_starts = np.concatenate((self.top_starts[nodes], np.broadcast_to([start, node], (len(nodes), 2))), axis=1)
+        order = np.lexsort((self.tour.position[merged_starts], -merged_results), axis=1)[:, :self.k]
+        top_starts = np.take_along_axis(merged_starts, order, axis=1)
+        changed = (top_starts != self.top_starts[nodes]).any(axis=1)
+        nodes = nodes[changed]
+        self.top_starts[nodes] = top_starts[changed]
+        self.top_results[nodes] = np.take_along_axis(merged_results, order, axis=1)[changed]
+        self.push(nodes)
+
+
+class RegretInsertionCache(InsertionCache):
+    def priority(self, nodes):
+        top_results = self.top_results[nodes]
+        regrets = np.where(top_results[:, 1:] > -float("inf"), top_results[:, :1] - top_results[:, 1:], 0).sum(axis=1)
+        return np.where(top_results[:, 0] > 0, regrets, -float("inf"))
+
+
+def cycle_expansion(instance, starting_node_index=0):
+    nodes = list(range(len(instance)))
     first_node = nodes[starting_node_index]
     nodes.remove(first_node)
-    second_node, second_node_result = find_nearest_neighbour(first_node, nodes)
-    nodes.remove(second_node)
-    cycle = [first_node, second_node, first_node]
-    cycle_values = [first_node.gain, second_node_result, second_node_result - second_node.gain]
+    second_node, second_node_result = find_nearest_neighbour(instance, first_node, nodes)
+    tour = Tour(len(instance), [first_node, second_node])
+    cycle_values = [instance.gain[first_node], second_node_result, second_node_result - instance.gain[second_node]]
+    insertions = InsertionCache(instance, tour)
 
     while True:
-        next_node, next_node_result, edge = find_nearest_expansion(nodes, cycle)
+        next_node, next_node_result, _ = insertions.best()
         if next_node is None or next_node_result < 0:
             break
 
-        nodes.remove(next_node)
         cycle_values.append(next_node_result)
-        cycle.insert(cycle[1::].index(edge[1]) + 1, next_node)
+        insertions.insert(next_node)
 
     final_value = sum(cycle_values)
-    return cycle, final_value
+    return tour.nodes.copy(), final_value
 
 
-def find_best_regret_expansion(nodes, cycle, cycle_values):
-    best_node = None
-    best_node_regret = None
-    broken_edge_index = None
-
-    for node in nodes:
-        first_best_edge_index = None
-        second_best_edge_index = None
-        first_best_edge_score = 0
-        second_best_edge_score = 0
-
-        for edge_index in range(len(cycle) - 1):
-            new_cycle_values = cycle_values.copy()
-            del new_cycle_values[2*edge_index]
-            new_cycle_values[2*edge_index:2*edge_index] = [-distance(node, cycle[edge_index]) * COST_WEIGHT, node.gain, -distance(node, cycle[edge_index + 1]) * COST_WEIGHT]
-            edge_break_result = sum(new_cycle_values) - sum(cycle_values)
-
-            if first_best_edge_index is None or edge_break_result > first_best_edge_score:
-                second_best_edge_index = first_best_edge_index
-                second_best_edge_score = first_best_edge_score
-                first_best_edge_index = edge_index
-                first_best_edge_score = edge_break_result
-            elif second_best_edge_index is None or edge_break_result > second_best_edge_score:
-                second_best_edge_index = edge_index
-                second_best_edge_score = edge_break_result
-
-        if first_best_edge_index is not None and first_best_edge_score > 0:
-            node_regret = first_best_edge_score - second_best_edge_score
-
-            if best_node is None or node_regret > best_node_regret:
-                best_node = node
-                best_node_regret = node_regret
-                broken_edge_index = first_best_edge_index
-
-    return best_node, broken_edge_index
-
-
-def insert_node_with_breaking_edge(node, edge_index, cycle, cycle_values):
-    del cycle_values[2 * edge_index]
-    cycle_values[2 * edge_index:2 * edge_index] = [-distance(node, cycle[edge_index]) * COST_WEIGHT, node.gain, -distance(node, cycle[edge_index + 1]) * COST_WEIGHT]
-    cycle.insert(edge_index + 1, node)
-    return cycle, cycle_values
-
-
-def cycle_expansion_with_regret(nodes, starting_node_index=0):
+def cycle_expansion_with_regret(instance, starting_node_index=0, k=2):
+    nodes = list(range(len(instance)))
     first_node = nodes[starting_node_index]
     nodes.remove(first_node)
-    second_node, second_node_result = find_nearest_neighbour(first_node, nodes)
-    nodes.remove(second_node)
-    cycle = [first_node, second_node, first_node]
-    cycle_values = [second_node_result - second_node.gain, second_node.gain, second_node_result - second_node.gain, first_node.gain]
+    second_node, second_node_result = find_nearest_neighbour(instance, first_node, nodes)
+    tour = Tour(len(instance), [first_node, second_node])
+    second_node_gain = instance.gain[second_node]
+    cycle_values = [second_node_result - second_node_gain, second_node_gain, second_node_result - second_node_gain, instance.gain[first_node]]
+    insertions = RegretInsertionCache(instance, tour, k)
 
     while True:
-        node, edge_index = find_best_regret_expansion(nodes, cycle, cycle_values)
+        node, node_result, _ = insertions.best()
 
         if node is None:
             break
 
-        nodes.remove(node)
-        cycle, cycle_values = insert_node_with_breaking_edge(node, edge_index, cycle, cycle_values)
+        cycle_values.append(node_result)
+        insertions.insert(node)
 
-    return cycle, sum(cycle_values)
+    return tour.nodes.copy(), sum(cycle_values)
 
 
-def print_result(nodes, result_nodes, result, title):
-    free_nodes = list(set(nodes) - set(result_nodes))
-    result_points = list(map(lambda node: (node.x, node.y), result_nodes))
-    free_points = list(map(lambda node: (node.x, node.y), free_nodes))
-    node_labels = list(map(lambda node: node.id, result_nodes))
+def print_result(instance, result_nodes, result, title):
+    free_nodes_views = instance.nodes(free_nodes(instance, result_nodes))
+    result_nodes_views = instance.nodes(close_cycle(result_nodes))
+    result_points = list(map(lambda node: (node.x, node.y), result_nodes_views))
+    free_points = list(map(lambda node: (node.x, node.y), free_nodes_views))
+    node_labels = list(map(lambda node: node.id, result_nodes_views))
     x, y = zip(*result_points)
     free_x, free_y = zip(*free_points)
 
@@ -212,15 +469,43 @@ def print_result(nodes, result_nodes, result, title):
     plt.show()
 
 
-def evaluate_solution(cycle):
-    solution_result = 0
-    for i in range(0, len(cycle) - 1):
-        solution_result += cycle[i].gain - distance(cycle[i], cycle[i + 1]) * COST_WEIGHT
-    return solution_result
+def ragged_tours(tours):
+    # tours is a list of tours or a tour matrix padded with -1 after the last node of each row;
+    # tour i is nodes[offsets[i]:offsets[i + 1]]
+    if isinstance(tours, np.ndarray) and tours.ndim == 2:
+        present = tours >= 0
+        nodes, lengths = tours[present], present.sum(axis=1)
+    else:
+        lengths = [len(tour) for tour in tours]
+        nodes = np.concatenate(tours) if len(tours) > 0 else np.empty(0, dtype=TOUR_DTYPE)
+    offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.intp)
+    return nodes, offsets
+
+
+def ragged_next_nodes(nodes, offsets):
+    next_positions = np.arange(1, len(nodes) + 1)
+    ends = offsets[1:][offsets[1:] > offsets[:-1]]
+    next_positions[ends - 1] = offsets[:-1][offsets[1:] > offsets[:-1]]
+    return nodes[next_positions]
 
 
-def verify_solution(cycle, result):
-    cycle_values = evaluate_solution(cycle)
+def evaluate_ragged(instance, nodes, offsets):
+    tour_of_node = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    gains = np.bincount(tour_of_node, instance.gain[nodes], minlength=len(offsets) - 1)
+    costs = np.bincount(tour_of_node, instance.costs[nodes, ragged_next_nodes(nodes, offsets)], minlength=len(offsets) - 1)
+    return gains - costs
+
+
+def evaluate_solutions(instance, tours):
+    return evaluate_ragged(instance, *ragged_tours(tours))
+
+
+def evaluate_solution(instance, cycle):
+    return evaluate_ragged(instance, cycle, np.array([0, len(cycle)]))[0]
+
+
+def verify_solution(instance, cycle, result):
+    cycle_values = evaluate_solution(instance, cycle)
 
     if result != cycle_values:
         return result - cycle_values
@@ -228,306 +513,787 @@ def verify_solution(cycle, result):
     return 0
 
 
-def remove_node(cycle, node_index):
-    if node_index == 0:
-        prev_node_index = -2
-    else:
-        prev_node_index = node_index - 1
-    next_node_index = node_index + 1
-    distance_gain = distance(cycle[prev_node_index], cycle[node_index]) * COST_WEIGHT + distance(cycle[next_node_index], cycle[node_index]) * COST_WEIGHT
-    node_result = distance_gain - cycle[node_index].gain - distance(cycle[prev_node_index], cycle[next_node_index]) * COST_WEIGHT
+def remove_node(instance, cycle, node_index):
+    prev_node = cycle[node_index - 1]
+    node = cycle[node_index]
+    next_node = cycle[(node_index + 1) % len(cycle)]
+    costs = instance.costs
+    distance_gain = costs[prev_node, node] + costs[next_node, node]
+    node_result = distance_gain - instance.gain[node] - costs[prev_node, next_node]
     return node_result
 
 
-def best_remove_node(cycle, random_remove=False):
-    starting_node = cycle[0]
-    starting_gain = distance(cycle[0], cycle[1]) * COST_WEIGHT + distance(cycle[0], cycle[-2]) * COST_WEIGHT
-    starting_result = starting_gain - cycle[0].gain - distance(cycle[-2], cycle[1]) * COST_WEIGHT
-
-    best_node = starting_node
-    best_node_result = starting_result
-
+def best_remove_node(instance, cycle, random_remove=False):
     if random_remove:
-        i = random.randint(1, len(cycle) - 2)
-        node_result = remove_node(cycle, i)
+        i = random.randint(0, len(cycle) - 1)
+        node_result = remove_node(instance, cycle, i)
         return cycle[i], node_result
 
-    for i in range(1, len(cycle) - 1):
-        node_result = remove_node(cycle, i)
-        if best_node is None or node_result > best_node_result:
-            best_node = cycle[i]
-            best_node_result = node_result
+    costs = instance.costs
+    prev_nodes, next_nodes = np.roll(cycle, 1), np.roll(cycle, -1)
+    distance_gains = costs[prev_nodes, cycle] + costs[next_nodes, cycle]
+    node_results = distance_gains - instance.gain[cycle] - costs[prev_nodes, next_nodes]
+    best = np.argmax(node_results)
 
-    return best_node, best_node_result
+    return cycle[best], node_results[best]
 
 
-def best_edge_swap(cycle):
+def best_edge_swap(instance, cycle):
     best_swap_result = -float("inf")
-    best_swapped_cycle = None
+    best_swap = None
+    costs = instance.costs
 
-    if len(cycle) - 1 <= 3:
-        return best_swapped_cycle, best_swap_result
+    if len(cycle) <= 3:
+        return best_swap, best_swap_result
 
-    for i in range(1, len(cycle) - 2):
-        for j in range(i+1, len(cycle) - 1):
-            if i == 1 and j == len(cycle) - 2:
-                continue
+    # reversing cycle[i:j + 1] replaces edges (i - 1, i) and (j, j + 1) with (i - 1, j) and (i, j + 1)
+    first = np.arange(1, len(cycle) - 1)
+    last = np.arange(2, len(cycle))
+    before_first, first_nodes = cycle[first - 1], cycle[first]
+    last_nodes, after_last = cycle[last], cycle[(last + 1) % len(cycle)]
+    total_change = (costs[before_first, first_nodes][:, np.newaxis] - costs[first_nodes][:, after_last]
+                    + costs[last_nodes, after_last][np.newaxis, :] - costs[before_first][:, last_nodes])
+    total_change[last[np.newaxis, :] <= first[:, np.newaxis]] = -float("inf")
+    total_change[0, -1] = -float("inf")
 
-            total_change = distance(cycle[i-1], cycle[i]) - distance(cycle[i], cycle[j+1]) + distance(cycle[j + 1], cycle[j]) - distance(cycle[j], cycle[i - 1])
-            total_change *= COST_WEIGHT
-            swapped_cycle = cycle.copy()
-            swapped_cycle[i:j + 1] = list(reversed(swapped_cycle[i:j + 1]))
+    i, j = np.unravel_index(np.argmax(total_change), total_change.shape)
+    if total_change[i, j] > best_swap_result:
+        best_swap = (int(first[i]), int(last[j]))
+        best_swap_result = total_change[i, j]
 
-            if best_swap_result is None or best_swap_result < total_change:
-                best_swap_result = total_change
-                best_swapped_cycle = swapped_cycle
+    return best_swap, best_swap_result
 
-    return best_swapped_cycle, best_swap_result
 
+def find_candidate_expansion(instance, tour, candidates):
+    best_node = None
+    best_node_result = -float("inf")
+    best_edge = None
+    costs = instance.costs
+    available_nodes = tour.free_nodes()
+
+    if len(available_nodes) == 0:
+        return best_node, best_node_result, best_edge
+
+    # a free node is only inserted right after or right before one of its candidate neighbours
+    cycle = tour.nodes
+    neighbour_positions = tour.position[candidates[available_nodes]]
+    edge_positions = np.concatenate((neighbour_positions, neighbour_positions - 1), axis=1) % len(cycle)
+    edge_starts, edge_ends = cycle[edge_positions], cycle[(edge_positions + 1) % len(cycle)]
+    nodes = available_nodes[:, np.newaxis]
+    node_results = instance.gain[nodes] + costs[edge_starts, edge_ends] - (costs[edge_starts, nodes] + costs[edge_ends, nodes])
+    node_results[~np.tile(neighbour_positions >= 0, 2)] = -float("inf")
+    node_index, edge_index = np.unravel_index(np.argmax(node_results), node_results.shape)
+
+    if node_results[node_index, edge_index] > best_node_result:
+        best_node = int(available_nodes[node_index])
+        best_node_result = node_results[node_index, edge_index]
+        best_edge = (edge_starts[node_index, edge_index], edge_ends[node_index, edge_index])
+    return best_node, best_node_result, best_edge
 
-def find_best_local(available_nodes, cycle, times):
+
+def best_candidate_edge_swap(instance, tour, candidates):
+    best_swap_result = -float("inf")
+    best_swap = None
+    costs = instance.costs
+    cycle = tour.nodes
+
+    if len(cycle) <= 3:
+        return best_swap, best_swap_result
+
+    # a node and its candidate neighbour become adjacent either by joining their successors
+    # (reverse low + 1..high) or their predecessors (reverse low..high - 1)
+    positions = np.arange(len(cycle))[:, np.newaxis]
+    neighbour_positions = tour.position[candidates[cycle]]
+    low, high = np.minimum(positions, neighbour_positions), np.maximum(positions, neighbour_positions)
+    first = np.concatenate((low + 1, low), axis=1)
+    last = np.concatenate((high, high - 1), axis=1)
+    # a segment starting at position 0 is reversed through its complement, like best_edge_swap does
+    wraps = first == 0
+    first, last = np.where(wraps, last + 1, first), np.where(wraps, len(cycle) - 1, last)
+    valid = np.tile(neighbour_positions >= 0, 2) & (first < last) & ~((first == 1) & (last == len(cycle) - 1))
+    first, last = first[valid], last[valid]
+
+    if len(first) == 0:
+        return best_swap, best_swap_result
+
+    before_first, first_nodes = cycle[first - 1], cycle[first]
+    last_nodes, after_last = cycle[last], cycle[(last + 1) % len(cycle)]
+    total_change = (costs[before_first, first_nodes] - costs[first_nodes, after_last]
+                    + costs[last_nodes, after_last] - costs[before_first, last_nodes])
+    best = np.argmax(total_change)
+    best_swap = (int(first[best]), int(last[best]))
+    best_swap_result = total_change[best]
+
+    return best_swap, best_swap_result
+
+
+def find_best_local(instance, tour, times, candidates=None):
     start = time.time()
-    next_node, next_node_result, edge = find_nearest_expansion(available_nodes.copy(), cycle.copy())
-    node_to_remove, remove_node_result = best_remove_node(cycle.copy())
-    new_cycle, swap_nodes_result = best_edge_swap(cycle.copy())
+    cycle = tour.nodes
+    if candidates is None:
+        next_node, next_node_result, edge = find_nearest_expansion(instance, tour.free_nodes(), cycle)
+        swap, swap_nodes_result = best_edge_swap(instance, cycle)
+    else:
+        next_node, next_node_result, edge = find_candidate_expansion(instance, tour, candidates)
+        swap, swap_nodes_result = best_candidate_edge_swap(instance, tour, candidates)
+    node_to_remove, remove_node_result = best_remove_node(instance, cycle)
     end = time.time()
     times.append(end-start)
     results = [next_node_result, remove_node_result, swap_nodes_result]
     best_local = np.argmax(results)
 
     if results[best_local] < 0:
-        return None, None, None, None
+        return None, None
     else:
         if best_local == 0:  # add Node
-            cycle.insert(cycle[1::].index(edge[1]) + 1, next_node)
-            return cycle, next_node_result, next_node, 1
+            tour.insert(tour.position[edge[0]] + 1, next_node)
+            return next_node_result, 1
         elif best_local == 1:  # remove Node
-            if node_to_remove == cycle[0]:
-                cycle.remove(node_to_remove)
-                cycle.remove(node_to_remove)
-                cycle.append(cycle[0])
-            else:
-                del cycle[cycle[1::].index(node_to_remove)+1]
-            return cycle, remove_node_result, node_to_remove, 2
+            tour.remove(tour.position[node_to_remove])
+            return remove_node_result, 2
         else:  # Swap edges
-            return new_cycle, swap_nodes_result, None, 3
+            tour.reverse(*swap)
+            return swap_nodes_result, 3
+
+
+class EvaluationCounter:
+    def __init__(self):
+        self.evaluations = 0
+
+    def count(self, moves):
+        self.evaluations += sum(len(results) for results, _ in moves)
 
 
-def enhance_solution_with_locals(cycle, available_nodes, cycle_values):
-    enhanced_cycle = cycle
-    nodes = available_nodes
+def neighbourhood_evaluations(tour, neighbourhood_size=None):
+    cycle_length, free_length = len(tour), len(tour.used) - len(tour)
+    if neighbourhood_size is None:
+        swaps = (cycle_length - 2) * (cycle_length - 1) // 2 - 1 if cycle_length > 3 else 0
+        return cycle_length * free_length + cycle_length + swaps
+    swaps = 2 * neighbourhood_size * cycle_length if cycle_length > 3 else 0
+    return 2 * neighbourhood_size * free_length + cycle_length + swaps
+
+
+def enhance_solution_with_locals(instance, cycle, cycle_values, neighbourhood_size=None, counter=None):
+    # neighbourhood_size limits add-node and 2-opt moves to that many nearest neighbours, None checks them all
+    candidates = None if neighbourhood_size is None else instance.candidate_lists(neighbourhood_size)
+    tour = Tour(len(instance), cycle)
     times = []
     while True:
-        new_cycle, delta, new_node, local_type = find_best_local(nodes, enhanced_cycle, times)
-        if new_cycle is not None:
-            enhanced_cycle = new_cycle
+        if counter is not None:
+            counter.evaluations += neighbourhood_evaluations(tour, neighbourhood_size)
+        delta, local_type = find_best_local(instance, tour, times, candidates)
+        if delta is not None:
             cycle_values += delta
-            if local_type == 1:
-                nodes.remove(new_node)
-            elif local_type == 2:
-                nodes.append(new_node)
         else:
             break
 
-    return enhanced_cycle, cycle_values, times
+    return tour.nodes.copy(), cycle_values, times
+
+
+# a move is (ADD_MOVE, node, edge start, edge end), (REMOVE_MOVE, node, neighbour, neighbour) or
+# (SWAP_MOVE, a, b, c, d) which replaces edges (a, b) and (c, d) with (a, c) and (b, d);
+# (EXCHANGE_MOVE, i, j) swaps the nodes at positions i and j
+ADD_MOVE, REMOVE_MOVE, SWAP_MOVE, EXCHANGE_MOVE = 1, 2, 3, 4
+
+
+def add_moves(instance, nodes, edge_starts, edge_ends):
+    results = insertion_results(instance, nodes, edge_starts, edge_ends)
+    edge_index, node_index = np.indices(results.shape)
+    moves = np.stack((np.full(results.shape, ADD_MOVE), nodes[node_index],
+                      edge_starts[edge_index], edge_ends[edge_index]), axis=-1)
+    return results.ravel(), moves.reshape(-1, 4)
+
+
+def remove_moves(instance, tour, nodes):
+    costs = instance.costs
+    cycle = tour.nodes
+    positions = tour.position[nodes]
+    prev_nodes, next_nodes = cycle[positions - 1], cycle[(positions + 1) % len(cycle)]
+    distance_gains = costs[prev_nodes, nodes] + costs[next_nodes, nodes]
+    results = distance_gains - instance.gain[nodes] - costs[prev_nodes, next_nodes]
+    moves = np.stack((np.full(len(nodes), REMOVE_MOVE), nodes, prev_nodes, next_nodes), axis=-1)
+    return results, moves
+
+
+def swap_moves(instance, a, b, c, d, both_reconnections=True):
+    # both reconnections of each edge pair; the one that would split the cycle is kept in the list
+    # until a reversal between the two edges makes it valid
+    costs = instance.costs
+    kinds = np.full(len(a), SWAP_MOVE)
+    moves = np.stack((kinds, a, b, c, d), axis=-1)
+    if both_reconnections:
+        moves = np.concatenate((moves, np.stack((kinds, a, b, d, c), axis=-1)))
+    a, b, c, d = moves[:, 1], moves[:, 2], moves[:, 3], moves[:, 4]
+    results = costs[a, b] - costs[b, d] + costs[c, d] - costs[a, c]
+    return results, moves
+
+
+def all_moves(instance, tour):
+    cycle = tour.nodes
+    next_nodes = np.roll(cycle, -1)
+    available_nodes = tour.free_nodes()
+    moves = []
+    if len(available_nodes) > 0:
+        moves.append(add_moves(instance, available_nodes, cycle, next_nodes))
+    if len(cycle) > 1:
+        moves.append(remove_moves(instance, tour, cycle))
+    if len(cycle) > 3:
+        first, second = np.triu_indices(len(cycle), 2)
+        disjoint = ~((first == 0) & (second == len(cycle) - 1))
+        first, second = first[disjoint], second[disjoint]
+        moves.append(swap_moves(instance, cycle[first], next_nodes[first], cycle[second], next_nodes[second]))
+    return moves
+
+
+def moves_around(instance, tour, new_edges, changed_nodes, freed_node):
+    cycle = tour.nodes
+    next_nodes = np.roll(cycle, -1)
+    edge_starts, edge_ends = np.array(new_edges, dtype=TOUR_DTYPE).T
+    available_nodes = tour.free_nodes()
+    moves = []
+    if len(available_nodes) > 0:
+        moves.append(add_moves(instance, available_nodes, edge_starts, edge_ends))
+    if freed_node is not None:
+        moves.append(add_moves(instance, np.array([freed_node]), cycle, next_nodes))
+    if len(cycle) > 1:
+        moves.append(remove_moves(instance, tour, np.unique(changed_nodes)))
+    if len(cycle) > 3:
+        a, b = edge_starts[:, np.newaxis], edge_ends[:, np.newaxis]
+        disjoint = (cycle != a) & (cycle != b) & (next_nodes != a) & (next_nodes != b)
+        rows, columns = np.nonzero(disjoint)
+        moves.append(swap_moves(instance, edge_starts[rows], edge_ends[rows], cycle[columns], next_nodes[columns]))
+    return moves
+
+
+def push_moves(move_list, moves):
+    for results, move_rows in moves:
+        improving = results > 0
+        for result, move in zip(results[improving].tolist(), move_rows[improving].tolist()):
+            heapq.heappush(move_list, (-result, tuple(move)))
+
+
+def move_state(tour, move):
+    # 1 when the move can be applied, 0 when its edges only point in the wrong direction, -1 when it is stale
+    if move[0] == ADD_MOVE:
+        _, node, start, end = move
+        return 1 if not tour.used[node] and tour.has_edge(start, end) else -1
+    if move[0] == REMOVE_MOVE:
+        _, node, prev_node, next_node = move
+        if not tour.used[node] or len(tour) <= 1:
+            return -1
+        return 1 if {tour.predecessor(node), tour.successor(node)} == {prev_node, next_node} else -1
+    _, a, b, c, d = move
+    if not (tour.has_edge(a, b) and tour.has_edge(c, d)):
+        return -1
+    return 1 if (tour.successor(a) == b) == (tour.successor(c) == d) else 0
+
+
+def pop_applicable_move(tour, move_list):
+    kept = []
+    best = None, None
+    while move_list:
+        entry = heapq.heappop(move_list)
+        state = move_state(tour, entry[1])
+        if state == 1:
+            best = -entry[0], entry[1]
+            break
+        if state == 0:
+            kept.append(entry)
+    for entry in kept:
+        heapq.heappush(move_list, entry)
+    return best
+
+
+def apply_move(tour, move):
+    # returns the edges the move created, the nodes whose neighbours changed and the node it freed
+    if move[0] == ADD_MOVE:
+        _, node, start, end = move
+        if tour.successor(start) != end:
+            start, end = end, start
+        tour.insert(tour.position[start] + 1, node)
+        return [(start, node), (node, end)], [start, node, end], None
+    if move[0] == REMOVE_MOVE:
+        node = move[1]
+        prev_node, next_node = tour.predecessor(node), tour.successor(node)
+        tour.remove(tour.position[node])
+        return [(prev_node, next_node)], [prev_node, next_node], node
+    _, a, b, c, d = move
+    if tour.successor(a) != b:
+        a, b, c, d = b, a, d, c
+    i, j = tour.position[a], tour.position[c]
+    tour.reverse(min(i, j) + 1, max(i, j))
+    return [(a, c), (b, d)], [a, b, c, d], None
+
+
+def enhance_solution_with_move_list(instance, cycle, cycle_values, counter=None):
+    # steepest descent that keeps improving moves between iterations and only evaluates the moves around
+    # what the applied move changed; the full neighbourhood is rescanned when no stored move applies
+    tour = Tour(len(instance), cycle)
+    move_list = []
+    times = []
+    while True:
+        start = time.time()
+        delta, move = pop_applicable_move(tour, move_list)
+        if move is None:
+            moves = all_moves(instance, tour)
+            if counter is not None:
+                counter.count(moves)
+            push_moves(move_list, moves)
+            delta, move = pop_applicable_move(tour, move_list)
+        if move is None:
+            times.append(time.time() - start)
+            break
+        cycle_values += delta
+        moves = moves_around(instance, tour, *apply_move(tour, move))
+        if counter is not None:
+            counter.count(moves)
+        push_moves(move_list, moves)
+        times.append(time.time() - start)
+
+    return tour.nodes.copy(), cycle_values, times
+
+
+def node_moves(instance, tour, node):
+    cycle = tour.nodes
+    if not tour.used[node]:
+        return [add_moves(instance, np.array([node]), cycle, np.roll(cycle, -1))]
+
+    # the moves that change one of the two edges around the node, 2-opt only in its valid reconnection
+    next_nodes = np.roll(cycle, -1)
+    edge_starts = np.array([tour.predecessor(node), node])
+    edge_ends = np.array([node, tour.successor(node)])
+    available_nodes = tour.free_nodes()
+    moves = []
+    if len(available_nodes) > 0:
+        moves.append(add_moves(instance, available_nodes, edge_starts, edge_ends))
+    if len(cycle) > 1:
+        moves.append(remove_moves(instance, tour, np.array([node])))
+    if len(cycle) > 3:
+        a, b = edge_starts[:, np.newaxis], edge_ends[:, np.newaxis]
+        disjoint = (cycle != a) & (cycle != b) & (next_nodes != a) & (next_nodes != b)
+        rows, columns = np.nonzero(disjoint)
+        moves.append(swap_moves(instance, edge_starts[rows], edge_ends[rows], cycle[columns], next_nodes[columns], False))
+    return moves
+
+
+def improve_from_nodes(instance, tour, nodes, cycle_values, times, counter=None):
+    # don't-look bits: only the given nodes are examined at first and a node is examined again once a move
+    # changes one of its edges; the first node with an improving move gets the best of its moves applied
+    queue = deque()
+    queued = np.zeros(len(instance), dtype=bool)
+    for node in nodes:
+        if not queued[node]:
+            queued[node] = True
+            queue.append(int(node))
+    start = time.time()
+    while queue:
+        node = queue.popleft()
+        queued[node] = False
+        moves = node_moves(instance, tour, node)
+        if counter is not None:
+            counter.count(moves)
+        best_result, move = 0, None
+        for results, move_rows in moves:
+            best = np.argmax(results)
+            if results[best] > best_result:
+                best_result, move = results[best], tuple(move_rows[best].tolist())
+        if move is None:
+            continue
+        cycle_values += best_result
+        _, changed_nodes, freed_node = apply_move(tour, move)
+        for changed_node in changed_nodes + [freed_node] + [node]:
+            if changed_node is not None and not queued[changed_node]:
+                queued[changed_node] = True
+                queue.append(int(changed_node))
+        times.append(time.time() - start)
+        start = time.time()
+    times.append(time.time() - start)
+
+    return cycle_values
+
+
+def enhance_solution_first_improvement(instance, cycle, cycle_values, counter=None):
+    tour = Tour(len(instance), cycle)
+    times = []
+    nodes = np.concatenate((cycle, tour.free_nodes()))
+    cycle_values = improve_from_nodes(instance, tour, nodes, cycle_values, times, counter)
+
+    return tour.nodes.copy(), cycle_values, times
 
 
-def generate_random_solution(nodes):
-    no_of_nodes = randint(1, len(nodes))
-    shuffled_nodes = nodes.copy()
+def generate_random_solution(instance):
+    no_of_nodes = randint(1, len(instance))
+    shuffled_nodes = list(range(len(instance)))
     random.shuffle(shuffled_nodes)
-    cycle = shuffled_nodes[0:no_of_nodes]
-    cycle.append(cycle[0])
-    cycle_values = evaluate_solution(cycle)
+    cycle = np.array(shuffled_nodes[0:no_of_nodes], dtype=TOUR_DTYPE)
+    cycle_values = evaluate_solution(instance, cycle)
 
     return cycle, cycle_values
 
 
-def multiple_start_local_search(nodes):
+def start_seeds(seed, count):
+    return [int(child.generate_state(1)[0]) for child in np.random.SeedSequence(seed).spawn(count)]
+
+
+def local_search_from_random_start(instance, local_search, seed):
+    random.seed(seed)
+    random_solution = generate_random_solution(instance)
+    enhanced_cycle, enhanced_result, _ = local_search(instance, random_solution[0], random_solution[1])
+    return enhanced_cycle.astype(TOUR_DTYPE), enhanced_result
+
+
+worker_state = {}
+
+
+def init_local_search_worker(instance_handle, local_search):
+    worker_state["instance"] = attach_instance(instance_handle)
+    worker_state["local_search"] = local_search
+
+
+def local_search_worker(seed):
+    return local_search_from_random_start(worker_state["instance"], worker_state["local_search"], seed)
+
+
+def multiple_start_local_search(instance, local_search=enhance_solution_with_locals, workers=None, seed=None, starts=100):
+    # every start gets its own seed from the master seed, so the best solution does not depend on workers;
+    # workers=None runs the starts in this process
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    seeds = start_seeds(seed, starts)
     best_solution = None
     start = time.time()
-    for i in range(0, 100):
-        print('MS LS completed: ' + str(100*i/100)+" %")
-        random_solution = generate_random_solution(nodes.copy())
-        enhanced_solution = enhance_solution_with_locals(random_solution[0].copy(), list(set(nodes.copy()) - set(random_solution[0])), random_solution[1])
-        if best_solution is None or enhanced_solution[1] > best_solution[1]:
-            best_solution = enhanced_solution
+    executor = None
+    shared_instance = None
+    if workers is None:
+        solutions = (local_search_from_random_start(instance, local_search, start_seed) for start_seed in seeds)
+    else:
+        shared_instance = SharedInstance(instance)
+        executor = ProcessPoolExecutor(workers, initializer=init_local_search_worker,
+                                       initargs=(shared_instance.handle, local_search))
+        solutions = executor.map(local_search_worker, seeds, chunksize=max(1, starts // (4 * workers)))
+    try:
+        for i, enhanced_solution in enumerate(solutions):
+            print('MS LS completed: ' + str(100*(i + 1)/starts)+" %")
+            if best_solution is None or enhanced_solution[1] > best_solution[1]:
+                best_solution = enhanced_solution
+    finally:
+        if executor is not None:
+            executor.shutdown()
+            shared_instance.close()
     end = time.time()
     duration = end - start
     return best_solution, duration
 
 
-def get_random_neighbour_solution(nodes, cycle, result):
-    cycle_values = result
-    decision_made = False
-
-    while not decision_made:
-        decision = random.randint(1, 3)
-        if decision == 1:
-            # swap nodes
-            if len(cycle) - 1 > 3:
-                cycle, delta = node_swap(cycle, True)
-                cycle_values += delta
-                decision_made = True
-        elif decision == 2:
-            # add node
-            if len(nodes) > 0:
-                next_node, next_node_result, edge = find_nearest_expansion(nodes, cycle, True)
-                nodes.remove(next_node)
-                cycle_values += next_node_result
-                cycle.insert(cycle[1::].index(edge[1]) + 1, next_node)
-                decision_made = True
-        else:
-            # remove node
-            if len(cycle) - 1 > 1:
-                node_to_remove, remove_node_result = best_remove_node(cycle, True)
-                del cycle[cycle[1::].index(node_to_remove) + 1]
-                cycle_values += remove_node_result
-                decision_made = True
+def random_free_node(tour):
+    # rejection sampling while at least half of the nodes are free, the free list otherwise
+    if 2 * len(tour) <= len(tour.used):
+        while True:
+            node = random.randrange(len(tour.used))
+            if not tour.used[node]:
+                return node
+    available_nodes = tour.free_nodes()
+    return int(available_nodes[random.randrange(len(available_nodes))])
+
+
+def random_move(instance, tour):
+    # a random node exchange, insertion or removal and its delta, without touching the tour;
+    # the move type is drawn from the feasible ones only
+    costs = instance.costs
+    order, length = tour.order, tour.length
+    move_types = []
+    if length > 3:
+        move_types.append(EXCHANGE_MOVE)
+    if length < len(tour.used):
+        move_types.append(ADD_MOVE)
+    if length > 1:
+        move_types.append(REMOVE_MOVE)
+    move_type = random.choice(move_types)
+
+    if move_type == EXCHANGE_MOVE:
+        i = random.randint(1, length - 3)
+        j = random.randint(i + 1, length - 2)
+        return (EXCHANGE_MOVE, i, j), calculate_node_swap(instance, order[:length], i, j)
+    if move_type == ADD_MOVE:
+        i = random.randint(0, length - 1)
+        start, end = order[i], order[(i + 1) % length]
+        node = random_free_node(tour)
+        node_result = instance.gain[node] + costs[start, end] - (costs[start, node] + costs[end, node])
+        return (ADD_MOVE, node, start, end), node_result
+    i = random.randint(0, length - 1)
+    prev_node, node, next_node = order[(i - 1) % length], order[i], order[(i + 1) % length]
+    node_result = costs[prev_node, node] + costs[next_node, node] - instance.gain[node] - costs[prev_node, next_node]
+    return (REMOVE_MOVE, node, prev_node, next_node), node_result
+
+
+def apply_random_move(tour, move):
+    if move[0] == EXCHANGE_MOVE:
+        tour.swap(move[1], move[2])
+    else:
+        apply_move(tour, move)
+
+
+def get_random_neighbour_solution(instance, tour, result):
+    move, delta = random_move(instance, tour)
+    apply_random_move(tour, move)
+    return tour, result + delta
 
-    return nodes, cycle, cycle_values
 
+def neighbourhood_of(tour, positions):
+    return [tour.order[position % tour.length] for position in positions]
 
-def perturbation(cycle, result):
-    # swap 2 nodes, remove random node, swap 2 nodes
-    if len(cycle) - 1 > 3:
-        new_cycle, delta = node_swap(cycle, True)
+
+def perturb(instance, tour, result):
+    # swap 2 nodes, remove random node, swap 2 nodes; also returns the nodes whose neighbours changed
+    touched = []
+    if len(tour) > 3:
+        swap, delta = node_swap(instance, tour.nodes, True)
+        tour.swap(*swap)
         cycle_values = result + delta
+        touched += neighbourhood_of(tour, [swap[0] - 1, swap[0], swap[0] + 1, swap[1] - 1, swap[1], swap[1] + 1])
 
-        node_to_remove = random.randint(0, len(new_cycle) - 2)
-        cycle_values = cycle_values + remove_node(new_cycle, node_to_remove)
-        if node_to_remove == 0:
-            new_cycle = new_cycle[1:-1]
-            new_cycle += [new_cycle[0]]
-        else:
-            del new_cycle[node_to_remove]
+        node_to_remove = random.randint(0, len(tour) - 1)
+        cycle_values = cycle_values + remove_node(instance, tour.nodes, node_to_remove)
+        touched.append(tour.remove(node_to_remove))
+        touched += neighbourhood_of(tour, [node_to_remove - 1, node_to_remove])
+
+        swap, delta = node_swap(instance, tour.nodes, True)
+        if swap is not None:
+            tour.swap(*swap)
+            cycle_values = cycle_values + delta
+            touched += neighbourhood_of(tour, [swap[0] - 1, swap[0], swap[0] + 1, swap[1] - 1, swap[1], swap[1] + 1])
+
+        return cycle_values, touched
 
-        new_cycle, delta = node_swap(new_cycle, True)
-        cycle_values = cycle_values + delta
+    return result, touched
 
-        return new_cycle, cycle_values
 
-    return cycle, result
+def perturbation(instance, tour, result):
+    result, _ = perturb(instance, tour, result)
+    return tour, result
 
 
-def iterated_local_search(nodes, stop_time):
-    best_solution = generate_random_solution(nodes.copy())
-    best_solution = enhance_solution_with_locals(best_solution[0].copy(), list(set(nodes.copy()) - set(best_solution[0])), best_solution[1])
+def iterated_local_search(instance, stop_time, counter=None):
+    # the kick and the local search around the nodes it touched change the tour in place,
+    # a result that is not better is undone through the tour journal
+    best_solution = generate_random_solution(instance)
+    best_solution = enhance_solution_with_locals(instance, best_solution[0], best_solution[1])
+    tour = Tour(len(instance), best_solution[0])
+    best_result = best_solution[1]
+    times = []
     start = time.time()
     while True:
-        enhanced_solution = perturbation(best_solution[0].copy(), best_solution[1])
-        if enhanced_solution[1] > best_solution[1]:
-            best_solution = enhanced_solution
+        tour.journal = []
+        result, touched = perturb(instance, tour, best_result)
+        result = improve_from_nodes(instance, tour, touched, result, times, counter)
+        if result > best_result:
+            best_result = result
+        else:
+            tour.rollback()
+        times.clear()
         if time.time() - start >= stop_time:
             break
+    tour.journal = None
 
-    return best_solution
-
-
-def reverse_nodes(nodes, node1, node2):
-    n1, n2 = nodes[1:-1].index(node1) + 1, nodes[1:-1].index(node2) + 1
-    nodes[n2], nodes[n1] = nodes[n1], nodes[n2]
-    return nodes
+    return tour.nodes.copy(), best_result
 
 
-def node_swap(cycle, random_swap=False):
-    if len(cycle) - 1 <= 3:
+def node_swap(instance, cycle, random_swap=False):
+    if len(cycle) <= 3:
         return None, -1
     best_swap_result = None
-    best_cycle = None
+    best_swap = None
 
     if random_swap:
-        i = random.randint(1, len(cycle) - 4)
-        j = random.randint(i+1, len(cycle) - 3)
-        swaped_cycle, swap_result = calculate_node_swap(cycle, i, j)
-        return swaped_cycle, swap_result
+        i = random.randint(1, len(cycle) - 3)
+        j = random.randint(i+1, len(cycle) - 2)
+        return (i, j), calculate_node_swap(instance, cycle, i, j)
 
-    for i in range(1, len(cycle) - 3):
-        for j in range(i + 1, len(cycle) - 2):
-            swaped_cycle, swap_result = calculate_node_swap(cycle, i, j)
+    for i in range(1, len(cycle) - 2):
+        for j in range(i + 1, len(cycle) - 1):
+            swap_result = calculate_node_swap(instance, cycle, i, j)
 
             if best_swap_result is None or best_swap_result < swap_result:
                 best_swap_result = swap_result
-                best_cycle = swaped_cycle
+                best_swap = (i, j)
+
+    return best_swap, best_swap_result
 
-    return best_cycle, best_swap_result
 
+def calculate_node_swap(instance, cycle, i, j):
+    costs = instance.costs
+    prev_node1, node1, next_node1 = cycle[i - 1], cycle[i], cycle[i + 1]
+    prev_node2, node2, next_node2 = cycle[j - 1], cycle[j], cycle[(j + 1) % len(cycle)]
 
-def calculate_node_swap(cycle, i, j):
-    before_delta_around_node1 = distance(cycle[i - 1], cycle[i]) + distance(cycle[i], cycle[i + 1])
-    before_delta_around_node2 = distance(cycle[j - 1], cycle[j]) + distance(cycle[j], cycle[j + 1])
-    before_delta_gain = (before_delta_around_node1 + before_delta_around_node2) * COST_WEIGHT
-    swaped_cycle = reverse_nodes(cycle.copy(), cycle[i], cycle[j])
-    after_delta_around_node1 = distance(swaped_cycle[i - 1], swaped_cycle[i]) + distance(swaped_cycle[i],
-                                                                                         swaped_cycle[i + 1])
-    after_delta_around_node2 = distance(swaped_cycle[j - 1], swaped_cycle[j]) + distance(swaped_cycle[j],
-                                                                                         swaped_cycle[j + 1])
-    after_delta_gain = (after_delta_around_node1 + after_delta_around_node2) * COST_WEIGHT
-    swap_result = before_delta_gain - after_delta_gain
+    if j == i + 1:
+        # the nodes are neighbours, so the edge between them survives the swap
+        return costs[prev_node1, node1] + costs[node2, next_node2] - costs[prev_node1, node2] - costs[node1, next_node2]
 
-    return swaped_cycle, swap_result
+    before_delta_gain = costs[prev_node1, node1] + costs[node1, next_node1] + costs[prev_node2, node2] + costs[node2, next_node2]
+    after_delta_gain = costs[prev_node1, node2] + costs[node2, next_node1] + costs[prev_node2, node1] + costs[node1, next_node2]
+    return before_delta_gain - after_delta_gain
 
 
-def simulated_annealing(nodes):
+def simulated_annealing(instance, L=1000, T0=75, Tk=1, alpha=0.98, checkpoint=None):
     start = time.time()
-    L = 1000
-    T0 = 75
-    Tk = 1
-    alpha = 0.98
-
-    random_solution = generate_random_solution(nodes.copy())
-    nodes = list(set(nodes) - set(random_solution[0]))
-    best_solution = random_solution[0]
-    best_result = random_solution[1]
-    best_global_solution = best_solution
-    best_global_result = best_result
-
-    T = T0
+    state = checkpoint.load() if checkpoint is not None else None
+
+    if state is None:
+        random_solution = generate_random_solution(instance)
+        tour = Tour(len(instance), random_solution[0])
+        result = random_solution[1]
+        best_global_solution = tour.nodes.copy()
+        best_global_result = result
+        T = T0
+    else:
+        tour = Tour(len(instance), state["tour"])
+        result = state["result"][()]
+        best_global_solution = state["best_tour"]
+        best_global_result = state["best_result"][()]
+        T = state["temperature"][()]
+        start -= state["elapsed"][()]
+
+    # moves are applied in place only when accepted, the tour is copied only for a new global best
     while T > Tk:
+        if checkpoint is not None and checkpoint.due():
+            checkpoint.save(tour=tour.nodes, result=result, best_tour=best_global_solution,
+                            best_result=best_global_result, temperature=T, elapsed=time.time() - start)
         for i in range(0, L):
-            new_nodes, new_solution, new_result = get_random_neighbour_solution(nodes.copy(), best_solution.copy(), best_result)
-            if new_result > best_result:
-                best_solution = new_solution
-                nodes = new_nodes
-                best_result = new_result
-            elif math.exp((new_result - best_result) / T) > random.uniform(0, 1):
-                best_solution = new_solution
-                nodes = new_nodes
-                best_result = new_result
-
-            if best_result > best_global_result:
-                best_global_result = best_result
-                best_global_solution = best_solution
+            move, delta = random_move(instance, tour)
+            if delta > 0 or math.exp(delta / T) > random.uniform(0, 1):
+                apply_random_move(tour, move)
+                result += delta
+
+                if result > best_global_result:
+                    best_global_result = result
+                    best_global_solution = tour.nodes.copy()
 
         T = T * alpha
 
+    if checkpoint is not None:
+        checkpoint.remove()
     duration = time.time() - start
     return best_global_solution, best_global_result, duration
 
 
-def flatten(list):
-    return [item for sublist in list for item in sublist]
+def chain_moves(instance, order, length, used, rng):
+    # one random exchange, insertion or removal per chain, drawn among the feasible types, with its delta;
+    # returns the move type (0 exchange, 1 insertion, 2 removal), two positions, the inserted node and the delta
+    costs, gain = instance.costs, instance.gain
+    rows = np.arange(len(order))
+    size = order.shape[1]
+    feasible = np.stack((length > 3, length < size, length > 1), axis=1)
+    move_type = np.argmax(rng.random(feasible.shape) * feasible, axis=1)
+
+    # node exchange of positions 1 <= i < j <= length - 2, as node_swap draws it
+    i = 1 + (rng.random(len(order)) * np.maximum(length - 3, 1)).astype(np.intp)
+    j = i + 1 + (rng.random(len(order)) * np.maximum(length - 2 - i, 1)).astype(np.intp)
+    prev_1, node_1, next_1 = order[rows, i - 1], order[rows, i], order[rows, i + 1]
+    prev_2, node_2, next_2 = order[rows, j - 1], order[rows, j], order[rows, (j + 1) % length]
+    before = costs[prev_1, node_1] + costs[node_1, next_1] + costs[prev_2, node_2] + costs[node_2, next_2]
+    after = costs[prev_1, node_2] + costs[node_2, next_1] + costs[prev_2, node_1] + costs[node_1, next_2]
+    adjacent = costs[prev_1, node_1] + costs[node_2, next_2] - costs[prev_1, node_2] - costs[node_1, next_2]
+    exchange_delta = np.where(j == i + 1, adjacent, before - after)
+
+    # insertion of a random free node after a random position, removal of the node at that position;
+    # the free node is the k-th unused one of the chains that insert
+    position = (rng.random(len(order)) * length).astype(np.intp)
+    node = np.zeros(len(order), dtype=np.intp)
+    inserting = np.flatnonzero(move_type == 1)
+    free_rank = np.cumsum(~used[inserting], axis=1)
+    k = (rng.random(len(inserting)) * (size - length[inserting])).astype(np.intp)
+    node[inserting] = np.argmax(free_rank > k[:, np.newaxis], axis=1)
+    start, end = order[rows, position], order[rows, (position + 1) % length]
+    add_delta = gain[node] + costs[start, end] - (costs[start, node] + costs[end, node])
+    prev_node, removed = order[rows, position - 1 + length * (position == 0)], order[rows, position]
+    remove_delta = costs[prev_node, removed] + costs[end, removed] - gain[removed] - costs[prev_node, end]
+
+    delta = np.choose(move_type, (exchange_delta, add_delta, remove_delta))
+    return move_type, i, j, position, node, delta
+
+
+def apply_chain_moves(order, length, used, accepted, move_type, i, j, position, node):
+    columns = np.arange(order.shape[1])
+    exchanged = np.flatnonzero(accepted & (move_type == 0))
+    order[exchanged, i[exchanged]], order[exchanged, j[exchanged]] = order[exchanged, j[exchanged]], order[exchanged, i[exchanged]]
+
+    inserted = np.flatnonzero(accepted & (move_type == 1))
+    if len(inserted) > 0:
+        after = (position[inserted] + 1)[:, np.newaxis]
+        shifted = order[inserted[:, np.newaxis], np.maximum(columns - 1, 0)]
+        order[inserted] = np.where(columns < after, order[inserted], np.where(columns == after, node[inserted][:, np.newaxis], shifted))
+        length[inserted] += 1
+        used[inserted, node[inserted]] = True
+
+    removed = np.flatnonzero(accepted & (move_type == 2))
+    if len(removed) > 0:
+        used[removed, order[removed, position[removed]]] = False
+        shifted = order[removed[:, np.newaxis], np.minimum(columns + 1, order.shape[1] - 1)]
+        order[removed] = np.where(columns < position[removed][:, np.newaxis], order[removed], shifted)
+        length[removed] -= 1
+
+
+def exchange_replicas(temperatures, values, rng, offset):
+    # neighbouring temperatures swap chains with the parallel tempering acceptance for a maximised objective
+    ladder = np.argsort(-temperatures)
+    pairs = (len(ladder) - offset) // 2
+    hot, cold = ladder[offset:offset + 2 * pairs:2], ladder[offset + 1:offset + 2 * pairs:2]
+    exponent = (1 / temperatures[hot] - 1 / temperatures[cold]) * (values[cold] - values[hot])
+    swapped = np.log(rng.random(len(hot))) < exponent
+    temperatures[hot[swapped]], temperatures[cold[swapped]] = temperatures[cold[swapped]], temperatures[hot[swapped]]
+
+
+# below this many chains a lockstep step costs more than running the chains one after another
+MULTI_CHAIN_MIN_CHAINS = 100
+
+
+def multi_chain_simulated_annealing(instance, chains=10, replica_exchange=False, exchange_interval=100, seed=None,
+                                    L=1000, T0=75, Tk=1, alpha=0.98):
+    # every chain follows the simulated_annealing schedule in lockstep; with replica_exchange the chains instead
+    # sit on a fixed geometric ladder from T0 to Tk for the same number of steps and swap temperatures;
+    # a step has a fixed numpy overhead, so this pays off only from about MULTI_CHAIN_MIN_CHAINS chains
+    start = time.time()
+    rng = np.random.default_rng(seed)
+    size = len(instance)
+
+    length = rng.integers(1, size + 1, chains)
+    order = np.zeros((chains, size), dtype=TOUR_DTYPE)
+    used = np.zeros((chains, size), dtype=bool)
+    for chain in range(chains):
+        order[chain, :length[chain]] = rng.permutation(size)[:length[chain]]
+        used[chain, order[chain, :length[chain]]] = True
+    values = evaluate_solutions(instance, [order[chain, :length[chain]] for chain in range(chains)])
+    best_order, best_length, best_values = order.copy(), length.copy(), values.copy()
+
+    levels = math.ceil(math.log(Tk / T0) / math.log(alpha))
+    temperatures = np.geomspace(T0, Tk, chains) if replica_exchange else np.full(chains, float(T0))
+    for level in range(levels):
+        for i in range(0, L):
+            move_type, first, second, position, node, delta = chain_moves(instance, order, length, used, rng)
+            accepted = (delta > 0) | (np.exp(np.minimum(delta, 0) / temperatures) > rng.random(chains))
+            apply_chain_moves(order, length, used, accepted, move_type, first, second, position, node)
+            values += np.where(accepted, delta, 0)
 
+            improved = values > best_values
+            best_order[improved], best_length[improved], best_values[improved] = order[improved], length[improved], values[improved]
 
-def rewrite_cycle_to_start_at(cycle, starting_node):
-    index = cycle.index(starting_node)
+            if replica_exchange and (level * L + i) % exchange_interval == exchange_interval - 1:
+                exchange_replicas(temperatures, values, rng, (level * L + i) // exchange_interval % 2)
 
-    if index == 0:
-        return cycle
+        if not replica_exchange:
+            temperatures *= alpha
 
-    cycle_first_half = cycle[index:]
-    cycle_second_half = cycle[1:index]
-    new_cycle = cycle_first_half + cycle_second_half + [cycle_first_half[0]]
-    return new_cycle
+    duration = time.time() - start
+    solutions = [(best_order[chain, :best_length[chain]].copy(), best_values[chain]) for chain in range(chains)]
+    return solutions, duration
 
 
-def unify_cycles(cycle_1, cycle_2):
-    for node in cycle_1:
-        if node in cycle_2:
-            new_cycle_1 = rewrite_cycle_to_start_at(cycle_1, node)
-            new_cycle_2 = rewrite_cycle_to_start_at(cycle_2, node)
-            return new_cycle_1, new_cycle_2
-    return None
+def flatten(list):
+    return [item for sublist in list for item in sublist]
+
+
+def rewrite_cycle_to_start_at(cycle, starting_node):
+    return np.roll(cycle, -index_of(cycle, starting_node))
 
 
 def find_first_index(sublist, list):
@@ -543,45 +1309,36 @@ def is_sublist(list, sublist):
     normal_result = False
     reverse_result = False
     if possible_start is not None:
-        normal_result = list[possible_start:possible_start + len(sublist)] == sublist
+        normal_result = np.array_equal(list[possible_start:possible_start + len(sublist)], sublist)
     if possible_start_for_reverse is not None:
-        reverse_result = list[possible_start_for_reverse:possible_start_for_reverse + len(sublist)] == sublist[::-1]
+        reverse_result = np.array_equal(list[possible_start_for_reverse:possible_start_for_reverse + len(sublist)], sublist[::-1])
     return normal_result or reverse_result
 
 
-def range_is_already_covered(found_ranges, new_range):
-    for found_range in found_ranges:
-        if new_range[0] >= found_range[0] and new_range[1] <= found_range[1]:
-            return True
-    return False
-
-
 def find_common_paths(cycle_1, cycle_2):
-    unification_result = unify_cycles(cycle_1, cycle_2)
-
-    if unification_result is None:
+    # the edges of cycle_2 as successor and predecessor arrays, then one pass over cycle_1 splits it
+    # wherever two consecutive nodes are not joined in cycle_2
+    size = max(cycle_1.max(), cycle_2.max()) + 1
+    next_nodes, prev_nodes = np.full(size, -1), np.full(size, -1)
+    next_nodes[cycle_2], prev_nodes[cycle_2] = np.roll(cycle_2, -1), np.roll(cycle_2, 1)
+    in_cycle_2 = next_nodes[cycle_1] >= 0
+
+    if not in_cycle_2.any():
         # this happens when cycles don't have any common node
         return []
 
-    cycle_1, cycle_2 = unification_result
-    common_parts_ranges = []
-
-    for starting_index in range(len(cycle_1) - 1):
-        for end_index in range(len(cycle_1) - 1, starting_index, -1):
-            cycle_1_part = cycle_1[starting_index:end_index]
-            new_range = (starting_index, end_index)
-
-            if is_sublist(cycle_2, cycle_1_part) and not range_is_already_covered(common_parts_ranges, new_range):
-                common_parts_ranges.append(new_range)
-                break
+    # paths are taken from cycle_1 starting at its first common node, without its closing edge
+    cycle_1 = np.roll(cycle_1, -int(np.argmax(in_cycle_2)))
+    joined = (next_nodes[cycle_1[:-1]] == cycle_1[1:]) | (prev_nodes[cycle_1[:-1]] == cycle_1[1:])
+    paths = np.split(cycle_1, np.flatnonzero(~joined) + 1)
 
-    return [cycle_1[found_range[0]:found_range[1]] for found_range in common_parts_ranges]
+    return [path.tolist() for path in paths if next_nodes[path[0]] >= 0]
 
 
 def get_unused_nodes(cycle_1, cycle_2, common_paths):
     common_paths_nodes = set(flatten(common_paths))
 
-    all_nodes = set(cycle_1) | set(cycle_2)
+    all_nodes = set(cycle_1.tolist()) | set(cycle_2.tolist())
 
     return [[x] for x in list(all_nodes - common_paths_nodes)]
 
@@ -589,8 +1346,8 @@ def get_unused_nodes(cycle_1, cycle_2, common_paths):
 def recombine(cycle_1, cycle_2):
     common_paths = find_common_paths(cycle_1, cycle_2)
 
-    additional_nodes_count = random.randint(min(len(cycle_1) - 1, len(cycle_2) - 1),
-                                            max(len(cycle_1) - 1, len(cycle_2) - 1)) - len(flatten(common_paths))
+    additional_nodes_count = random.randint(min(len(cycle_1), len(cycle_2)),
+                                            max(len(cycle_1), len(cycle_2))) - len(flatten(common_paths))
 
     unused = get_unused_nodes(cycle_1, cycle_2, common_paths)
     random.shuffle(unused)
@@ -606,109 +1363,254 @@ def recombine(cycle_1, cycle_2):
             new_cycle_parts[i] = reversed
 
     new_cycle = flatten(new_cycle_parts)
-    new_cycle = new_cycle + [new_cycle[0]]
 
-    return new_cycle
+    return np.array(new_cycle, dtype=TOUR_DTYPE)
 
 
-def find_worst_solution(solutions):
-    worst = None
-    worst_result = float("inf")
+def find_worst_solution(instance, solutions):
+    if len(solutions) == 0:
+        return None, float("inf")
 
-    for solution in solutions:
-        solution_result = evaluate_solution(solution)
+    results = evaluate_solutions(instance, solutions)
+    worst = int(np.argmin(results))
+    return solutions[worst], results[worst]
 
-        if solution_result < worst_result:
-            worst_result = solution_result
-            worst = solution
 
-    return worst, worst_result
+def find_best_solution(instance, solutions):
+    if len(solutions) == 0:
+        return None, -float("inf")
 
+    results = evaluate_solutions(instance, solutions)
+    best = int(np.argmax(results))
+    return solutions[best], results[best]
 
-def find_best_solution(solutions):
-    best = None
-    best_result = -float("inf")
 
-    for solution in solutions:
-        solution_result = evaluate_solution(solution)
+def check_for_duplicates(cycle):
+    return len(np.unique(cycle)) < len(cycle)
 
-        if solution_result > best_result:
-            best_result = solution_result
-            best = solution
 
-    return best, best_result
+def solution_already_exists(population, solution):
+    key = tour_key(solution)
+    return any(tour_key(existing) == key for existing in population)
+
+
+def canonical_tour(cycle):
+    # rotated to start at the smallest node and read in the direction with the smaller second node
+    forward = np.roll(cycle, -int(np.argmin(cycle)))
+    backward = np.roll(forward[::-1], 1)
+    if len(cycle) > 2 and backward[1] < forward[1]:
+        return backward
+    return forward
+
+
+def tour_key(cycle):
+    return canonical_tour(np.asarray(cycle, dtype=TOUR_DTYPE)).tobytes()
+
+
+class Population:
+    # members keep the value they were added with; the heap has the worst member on top
+    # and the canonical keys of all members make duplicate checks a set lookup
+    def __init__(self):
+        self.tours = []
+        self.values = []
+        self.keys = []
+        self.key_set = set()
+        self.heap = []
+        self.best_index = None
+
+    def __len__(self):
+        return len(self.tours)
+
+    def __contains__(self, tour):
+        return tour_key(tour) in self.key_set
+
+    def add(self, tour, value):
+        self.tours.append(tour)
+        self.values.append(value)
+        self.keys.append(tour_key(tour))
+        self.key_set.add(self.keys[-1])
+        heapq.heappush(self.heap, (value, len(self.tours) - 1))
+        self.update_best(len(self.tours) - 1)
+
+    def update_best(self, index):
+        if self.best_index is None or self.values[index] > self.values[self.best_index]:
+            self.best_index = index
+
+    def best(self):
+        return self.tours[self.best_index], self.values[self.best_index]
+
+    def worst(self):
+        value, index = self.heap[0]
+        return self.tours[index], value
+
+    def replace_worst(self, tour, value):
+        _, index = self.heap[0]
+        self.key_set.discard(self.keys[index])
+        self.tours[index] = tour
+        self.values[index] = value
+        self.keys[index] = tour_key(tour)
+        self.key_set.add(self.keys[index])
+        heapq.heapreplace(self.heap, (value, index))
+        if index == self.best_index:
+            self.best_index = int(np.argmax(self.values))
+        else:
+            self.update_best(index)
 
 
-def check_for_duplicates(cycle):
-    cut = cycle[:-1]
-    for i in range(len(cut)):
-        for next_node in cut[i + 1:]:
-            if cut[i].id == next_node.id:
-                return True
-    return False
+def population_state(population):
+    nodes, offsets = ragged_tours(population.tours)
+    return {"nodes": nodes, "offsets": offsets, "values": np.array(population.values),
+            "best_index": -1 if population.best_index is None else population.best_index}
 
 
-def solution_already_exists(population, solution):
-    for existing in population:
-        unified = unify_cycles(existing, solution)
+def population_from_state(state):
+    # members are added in their saved order, so tour indices, the heap and the best member match the saved run
+    population = Population()
+    nodes, offsets = state["nodes"], state["offsets"]
+    for index, value in enumerate(state["values"]):
+        population.add(nodes[offsets[index]:offsets[index + 1]], value[()])
+    if len(population) > 0:
+        population.best_index = int(state["best_index"])
+    return population
 
-        if unified is not None and (unified[0] == unified[1] or unified[0][::-1] == unified[1]):
-            return True
 
-    return False
+def generate_population(instance, population_size, local_search=enhance_solution_with_locals, checkpoint=None,
+                        state=None):
+    population = Population() if state is None else population_from_state(state)
 
+    while len(population) < population_size:
+        if checkpoint is not None and checkpoint.due():
+            checkpoint.save(**population_state(population))
+        random_solution = generate_random_solution(instance)
+        enhanced_random_solution, enhanced_result, _ = local_search(instance, random_solution[0], random_solution[1])
 
-def genetic_algorithm(nodes, stop_time):
-    population = []
+        if enhanced_random_solution not in population:
+            population.add(enhanced_random_solution, enhanced_result)
 
-    while len(population) < 20:
-        random_solution = generate_random_solution(nodes.copy())
-        enhanced_random_solution = enhance_solution_with_locals(random_solution[0], list(set(nodes) - set(random_solution[0])), random_solution[1])[0]
+    return population
 
-        if not solution_already_exists(population, enhanced_random_solution):
-            population.append(enhanced_random_solution)
 
-    print("Population generated")
-
-    start_time = time.time()
+def evolve_population(instance, population, stop_time, local_search=enhance_solution_with_locals, checkpoint=None,
+                      state=None):
+    # a resumed run continues with its saved generation count and only the rest of its time budget
+    generations = 0 if state is None else int(state["generations"])
+    start_time = time.time() - (0 if state is None else state["elapsed"][()])
     while True:
         if time.time() - start_time >= stop_time:
             break
+        if checkpoint is not None and checkpoint.due():
+            checkpoint.save(generations=generations, elapsed=time.time() - start_time, **population_state(population))
+        generations += 1
 
-        parent_1 = random.choice(population)
-        parent_2 = random.choice(population)
+        parent_1 = random.choice(population.tours)
+        parent_2 = random.choice(population.tours)
 
         child = recombine(parent_1, parent_2)
 
-        enhanced_child, enhanced_child_result, _ = enhance_solution_with_locals(child.copy(), list(set(nodes) - set(child)), evaluate_solution(child))
+        enhanced_child, enhanced_child_result, _ = local_search(instance, child, evaluate_solution(instance, child))
+
+        _, worst_solution_result = population.worst()
 
-        worst_existing_solution, worst_solution_result = find_worst_solution(population)
+        if enhanced_child_result > worst_solution_result and enhanced_child not in population:
+            population.replace_worst(enhanced_child, enhanced_child_result)
 
-        if enhanced_child_result > worst_solution_result and not solution_already_exists(population, enhanced_child):
-            population.remove(worst_existing_solution)
-            population.append(enhanced_child)
+    return population, generations
 
-    return find_best_solution(population)
+
+def genetic_algorithm(instance, stop_time, local_search=enhance_solution_with_locals, population_size=20,
+                      checkpoint=None):
+    # checkpoints of the evolution phase carry a generation count, those of the generation phase do not
+    state = checkpoint.load() if checkpoint is not None else None
+    if state is not None and "generations" in state:
+        population = population_from_state(state)
+    else:
+        population = generate_population(instance, population_size, local_search, checkpoint, state)
+        print("Population generated")
+        state = None
+
+    population, _ = evolve_population(instance, population, stop_time, local_search, checkpoint, state)
+
+    if checkpoint is not None:
+        checkpoint.remove()
+    return population.best()
+
+
+def island_worker(population, population_size, stop_time, seed):
+    instance, local_search = worker_state["instance"], worker_state["local_search"]
+    random.seed(seed)
+    if population is None:
+        population = generate_population(instance, population_size, local_search)
+    return evolve_population(instance, population, stop_time, local_search)
+
+
+def migrate(populations, topology, rng):
+    # every island sends its best tour to one other island, where it replaces the worst tour if better
+    if len(populations) < 2:
+        return populations
+    if topology == "ring":
+        targets = [(island + 1) % len(populations) for island in range(len(populations))]
+    elif topology == "random":
+        targets = [rng.choice([other for other in range(len(populations)) if other != island])
+                   for island in range(len(populations))]
+    else:
+        raise ValueError("Unknown migration topology: " + str(topology))
+
+    migrants = [population.best() for population in populations]
+    for (migrant, migrant_result), target in zip(migrants, targets):
+        population = populations[target]
+        if migrant_result > population.worst()[1] and migrant not in population:
+            population.replace_worst(migrant, migrant_result)
+    return populations
+
+
+def island_genetic_algorithm(instance, stop_time, islands=4, population_size=20, migration_interval=None,
+                             topology="ring", local_search=enhance_solution_with_locals, seed=None, workers=None):
+    # every island evolves in its own process for migration_interval seconds, then the islands exchange migrants
+    if migration_interval is None:
+        migration_interval = stop_time / 10
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    rng = random.Random(seed)
+    epochs = max(1, math.ceil(stop_time / migration_interval))
+    populations = [None] * islands
+    generations = 0
+
+    with SharedInstance(instance) as shared_instance, \
+            ProcessPoolExecutor(workers or islands, initializer=init_local_search_worker,
+                                initargs=(shared_instance.handle, local_search)) as executor:
+        for epoch in range(epochs):
+            epoch_time = min(migration_interval, stop_time - epoch * migration_interval)
+            seeds = start_seeds([seed, epoch], islands)
+            results = list(executor.map(island_worker, populations, [population_size] * islands,
+                                        [epoch_time] * islands, seeds))
+            populations = [population for population, _ in results]
+            generations += sum(island_generations for _, island_generations in results)
+            if epoch < epochs - 1:
+                populations = migrate(populations, topology, rng)
+
+    print("Island GA generations: {}".format(generations))
+    return max((population.best() for population in populations), key=lambda solution: solution[1])
 
 
 def count_common_nodes(cycle_1, cycle_2):
     common_nodes = 0
-    for node_1 in cycle_1[:-1]:
-        if node_1 in cycle_2[:-1]:
+    for node_1 in cycle_1:
+        if node_1 in cycle_2:
             common_nodes += 1
     return common_nodes
 
 
 def percentage_of_common_nodes(cycle_1, cycle_2):
-    average_no_of_nodes = (len(cycle_1[:-1]) + len(cycle_2[:-1]))/2
+    average_no_of_nodes = (len(cycle_1) + len(cycle_2))/2
     common_nodes = count_common_nodes(cycle_1, cycle_2)
     return common_nodes/average_no_of_nodes
 
 
 def count_common_edges(cycle_1, cycle_2):
     common_edges = 0
+    cycle_1, cycle_2 = close_cycle(cycle_1), close_cycle(cycle_2)
     for i in range(len(cycle_1) - 1):
-        edge = [cycle_1[i], cycle_1[i + 1]]
+        edge = cycle_1[i:i + 2]
         if is_sublist(cycle_2, edge):
             common_edges += 1
 
@@ -716,56 +1618,68 @@ def count_common_edges(cycle_1, cycle_2):
 
 
 def percentage_of_common_edges(cycle_1, cycle_2):
-    average_no_of_edges = (len(cycle_1) - 1 + len(cycle_2) - 1)/2
+    average_no_of_edges = (len(cycle_1) + len(cycle_2))/2
     common_edges = count_common_edges(cycle_1, cycle_2)
     return common_edges/average_no_of_edges
 
 
-def generate_chart_data(solutions):
-    best_solution = find_best_solution(solutions)[0]
+def incidence_matrices(solutions, size):
+    # a row per tour: which nodes it visits, and how often it uses each undirected edge u * size + v, u <= v
+    nodes, offsets = ragged_tours(solutions)
+    rows = np.repeat(np.arange(len(solutions)), np.diff(offsets))
+    next_nodes = ragged_next_nodes(nodes, offsets)
+    node_incidence = np.zeros((len(solutions), size))
+    node_incidence[rows, nodes] = 1
+    edges = np.minimum(nodes, next_nodes) * size + np.maximum(nodes, next_nodes)
+    edge_counts = sparse.csr_matrix((np.ones(len(edges)), (rows, edges)), shape=(len(solutions), size * size))
+    return node_incidence, edge_counts
+
+
+def similarity_matrices(instance, solutions):
+    # entry (i, j) is percentage_of_common_nodes / percentage_of_common_edges of solutions i and j;
+    # an edge used twice by a two-node tour counts twice on its own side, like count_common_edges does
+    node_incidence, edge_counts = incidence_matrices(solutions, len(instance))
+    common_nodes = node_incidence @ node_incidence.T
+    common_edges = (edge_counts @ edge_counts.sign().T).toarray()
+    lengths = np.array([len(solution) for solution in solutions])
+    average_lengths = (lengths[:, np.newaxis] + lengths[np.newaxis, :]) / 2
+    return common_nodes / average_lengths, common_edges / average_lengths
+
+
+def generate_chart_data(instance, solutions, values=None):
+    if values is None:
+        values = evaluate_solutions(instance, solutions).tolist()
+    best = int(np.argmax(values))
+
+    common_nodes, common_edges = similarity_matrices(instance, solutions)
+    best_common_nodes = common_nodes[:, best] * 100
+    best_common_edges = common_edges[:, best] * 100
+    with np.errstate(invalid="ignore", divide="ignore"):
+        average_common_nodes = (common_nodes.sum(axis=1) - common_nodes.diagonal()) / (len(solutions) - 1) * 100
+        average_common_edges = (common_edges.sum(axis=1) - common_edges.diagonal()) / (len(solutions) - 1) * 100
 
     x = []
     best_common_nodes_percentages = []
     best_common_edges_percentages = []
     average_common_nodes_percentages = []
     average_common_edges_percentages = []
-
-    for sol_i, solution in enumerate(solutions):
-        solution_value = evaluate_solution(solution)
-        
-        best_common_nodes_percentage = percentage_of_common_nodes(solution, best_solution) * 100
-        best_common_edges_percentage = percentage_of_common_edges(solution, best_solution) * 100
-
-        common_nodes_percentages = []
-        common_edges_percentages = []
-
-        for another_i, another_solution in enumerate(solutions):
-            if another_i != sol_i:
-                another_solution_common_nodes_percentage = percentage_of_common_nodes(solution, another_solution)
-                another_solution_common_edges_percentage = percentage_of_common_edges(solution, another_solution)
-
-                common_nodes_percentages.append(another_solution_common_nodes_percentage)
-                common_edges_percentages.append(another_solution_common_edges_percentage)
-
-        average_common_nodes_percentage = np.mean(common_nodes_percentages) * 100
-        average_common_edges_percentage = np.mean(common_edges_percentages) * 100
-
-        if solution_value in x:
-            ind = x.index(solution_value)
-            best_common_nodes_percentages[ind] = np.mean(
-                [best_common_nodes_percentages[ind], best_common_nodes_percentage])
-            best_common_edges_percentages[ind] = np.mean(
-                [best_common_edges_percentages[ind], best_common_edges_percentage])
-            average_common_nodes_percentages[ind] = np.mean(
-                [average_common_nodes_percentages[ind], average_common_nodes_percentage])
-            average_common_edges_percentages[ind] = np.mean(
-                [average_common_edges_percentages[ind], average_common_edges_percentage])
+    value_indices = {}
+
+    # a repeated value is folded into its point as the mean of the point and the new solution
+    for sol_i, solution_value in enumerate(values):
+        if solution_value in value_indices:
+            ind = value_indices[solution_value]
+            best_common_nodes_percentages[ind] = (best_common_nodes_percentages[ind] + best_common_nodes[sol_i]) / 2
+            best_common_edges_percentages[ind] = (best_common_edges_percentages[ind] + best_common_edges[sol_i]) / 2
+            average_common_nodes_percentages[ind] = (average_common_nodes_percentages[ind] + average_common_nodes[sol_i]) / 2
+            average_common_edges_percentages[ind] = (average_common_edges_percentages[ind] + average_common_edges[sol_i]) / 2
         else:
+            value_indices[solution_value] = len(x)
             x.append(solution_value)
-            best_common_nodes_percentages.append(best_common_nodes_percentage)
-            best_common_edges_percentages.append(best_common_edges_percentage)
-            average_common_nodes_percentages.append(average_common_nodes_percentage)
-            average_common_edges_percentages.append(average_common_edges_percentage)
+            best_common_nodes_percentages.append(best_common_nodes[sol_i])
+            best_common_edges_percentages.append(best_common_edges[sol_i])
+            average_common_nodes_percentages.append(average_common_nodes[sol_i])
+            average_common_edges_percentages.append(average_common_edges[sol_i])
 
     return x, average_common_nodes_percentages, average_common_edges_percentages, best_common_nodes_percentages, best_common_edges_percentages
 
@@ -798,29 +1712,108 @@ def show_charts(chart_data):
     plot_with_regression_line(x, best_common_edges_percentages, "Edges correspondence with best solution")
 
 
-def lab_5_results():
-    nodes = read_data("./data")
-    solutions = []
+def lab_5_results(local_search=enhance_solution_with_locals, checkpoint=None):
+    instance = read_data("./data")
+    state = checkpoint.load() if checkpoint is not None else None
+    solutions = Population() if state is None else population_from_state(state)
     no_of_solutions = 1000
     print("Generating solutions...")
 
     while True:
-        random_sol = generate_random_solution(nodes)
-        ls_enhanced, _, _ = enhance_solution_with_locals(random_sol[0], list(set(nodes) - set(random_sol[0])), random_sol[1])
-        if not solution_already_exists(solutions, ls_enhanced):
-            solutions.append(ls_enhanced)
+        if checkpoint is not None and checkpoint.due():
+            checkpoint.save(**population_state(solutions))
+        random_sol = generate_random_solution(instance)
+        ls_enhanced, ls_result, _ = local_search(instance, random_sol[0], random_sol[1])
+        if ls_enhanced not in solutions:
+            solutions.add(ls_enhanced, ls_result)
             print("Generated {} of {}".format(len(solutions), no_of_solutions))
 
         if len(solutions) >= no_of_solutions:
             break
 
-    chart_data = generate_chart_data(solutions)
+    if checkpoint is not None:
+        checkpoint.remove()
+    chart_data = generate_chart_data(instance, solutions.tours, solutions.values)
 
     show_charts(chart_data)
 
 
-def lab_4_results():
-    nodes = read_data("./data")
+def race_survivors(values, alpha):
+    # values holds one row per repetition (block) and one column per configuration, higher is better;
+    # returns the indices of the configurations that are not significantly worse than the best one
+    blocks, size = values.shape
+    ranks = stats.rankdata(-values, axis=1)
+    if size == 2:
+        differences = values[:, 0] - values[:, 1]
+        if not differences.any() or stats.wilcoxon(differences).pvalue >= alpha:
+            return [0, 1]
+        return [int(np.argmax(values.mean(axis=0)))]
+
+    # Friedman test followed by the Conover post-hoc comparison against the best rank sum, as in F-race
+    rank_sums = ranks.sum(axis=0)
+    squared_ranks = np.sum(ranks ** 2)
+    correction = blocks * size * (size + 1) ** 2 / 4
+    if squared_ranks == correction:
+        return list(range(size))
+    statistic = (size - 1) * (np.sum(rank_sums ** 2) - blocks * correction) / (squared_ranks - correction)
+    if stats.chi2.sf(statistic, size - 1) >= alpha:
+        return list(range(size))
+    spread = np.sqrt(2 * blocks * (1 - statistic / (blocks * (size - 1))) * (squared_ranks - correction)
+                     / ((blocks - 1) * (size - 1)))
+    threshold = stats.t.ppf(1 - alpha / 2, (blocks - 1) * (size - 1)) * spread
+    return [index for index in range(size) if rank_sums[index] - rank_sums.min() <= threshold]
+
+
+def race(configurations, max_repetitions=10, min_repetitions=3, alpha=0.05):
+    # runs every surviving configuration once per round with the round's seed, so rounds are blocks,
+    # and from min_repetitions rounds on drops the configurations that are statistically worse
+    results = {name: [] for name in configurations}
+    durations = {name: [] for name in configurations}
+    eliminated = {}
+    alive = list(configurations)
+
+    for repetition in range(max_repetitions):
+        for name in alive:
+            random.seed(repetition)
+            start = time.time()
+            solution = configurations[name](repetition)
+            durations[name].append(time.time() - start)
+            results[name].append(solution)
+
+        if len(alive) > 1 and repetition + 1 >= min_repetitions:
+            values = np.array([[value for _, value in results[name]] for name in alive]).T
+            survivors = [alive[index] for index in race_survivors(values, alpha)]
+            for name in alive:
+                if name not in survivors:
+                    eliminated[name] = repetition + 1
+            alive = survivors
+
+    # a dropped configuration would have kept its own mean run time for the remaining rounds
+    runs = sum(len(times) for times in durations.values())
+    saved_time = sum((max_repetitions - len(times)) * np.mean(times) for times in durations.values())
+    print('Race: {} of {} runs, saved {} runs, about {:.1f}s'.format(
+        runs, len(configurations) * max_repetitions, len(configurations) * max_repetitions - runs, saved_time))
+    for name in configurations:
+        values = [value for _, value in results[name]]
+        status = 'survived' if name in alive else 'dropped after {} runs'.format(eliminated[name])
+        print('{} - {}, best: {}, worst: {}, average: {}'.format(name, status, max(values), min(values), np.mean(values)))
+
+    return alive, results
+
+
+def lab_4_results(racing=False):
+    instance = read_data("./data")
+    if racing:
+        _, stop_time = multiple_start_local_search(instance)
+        race({
+            'MultipleStart LS': lambda seed: multiple_start_local_search(instance, seed=seed)[0],
+            'Iterated LS': lambda seed: iterated_local_search(instance, stop_time),
+            'Genetic, population 10': lambda seed: genetic_algorithm(instance, stop_time, population_size=10),
+            'Genetic, population 20': lambda seed: genetic_algorithm(instance, stop_time, population_size=20),
+            'Genetic, population 40': lambda seed: genetic_algorithm(instance, stop_time, population_size=40),
+        })
+        return
+
     multiple_start_times = []
     multiple_start_results = []
     best_multiple_start_solution = None
@@ -834,8 +1827,8 @@ def lab_4_results():
 
     for i in range(0, 10):
         print('MultipleStart LS')
-        solution, duration = multiple_start_local_search(nodes.copy())
-        if verify_solution(solution[0], solution[1]) > 1:
+        solution, duration = multiple_start_local_search(instance)
+        if verify_solution(instance, solution[0], solution[1]) > 1:
             raise ValueError("Node path verification failed")
         multiple_start_times.append(duration)
         multiple_start_results.append(solution[1])
@@ -848,8 +1841,8 @@ def lab_4_results():
 
     for i in range(0, 10):
         print('Iterated LS')
-        solution = iterated_local_search(nodes.copy(), stop_time)
-        if verify_solution(solution[0], solution[1]) > 1:
+        solution = iterated_local_search(instance, stop_time)
+        if verify_solution(instance, solution[0], solution[1]) > 1:
             raise ValueError("Node path verification failed")
         iterated_ls_results.append(solution[1])
         if best_iterated_ls_solution is None or solution[1] > best_iterated_ls_result:
@@ -858,29 +1851,41 @@ def lab_4_results():
 
     for i in range(0, 10):
         print('Genetic')
-        solution = genetic_algorithm(nodes.copy(), stop_time)
-        if verify_solution(solution[0], solution[1]) > 1:
+        solution = genetic_algorithm(instance, stop_time)
+        if verify_solution(instance, solution[0], solution[1]) > 1:
             raise ValueError("Node path verification failed")
         genetic_results.append(solution[1])
         if best_genetic_solution is None or solution[1] > best_genetic_result:
             best_genetic_solution = solution[0]
             best_genetic_result = solution[1]
 
-    print_result(nodes, best_multiple_start_solution, best_multiple_start_result, 'MultipleStart LS')
+    print_result(instance, best_multiple_start_solution, best_multiple_start_result, 'MultipleStart LS')
     print('MultipleStart LS - best: {}, worst: {}, average: {}. Times: min {}, max {}, avg {}'.format(best_multiple_start_result, min(multiple_start_results), np.mean(multiple_start_results), min(multiple_start_times), max(multiple_start_times), np.mean(multiple_start_times)))
-    print(list(map(lambda node: int(node.id), best_multiple_start_solution)))
+    print(list(map(lambda node: int(node.id), instance.nodes(best_multiple_start_solution))))
 
-    print_result(nodes, best_iterated_ls_solution, best_iterated_ls_result, 'Iterated LS')
+    print_result(instance, best_iterated_ls_solution, best_iterated_ls_result, 'Iterated LS')
     print('Iterated LS - best: {}, worst: {}, average: {}. Stop time: {}'.format(best_iterated_ls_result, min(iterated_ls_results), np.mean(iterated_ls_results), stop_time))
-    print(list(map(lambda node: int(node.id), best_iterated_ls_solution)))
+    print(list(map(lambda node: int(node.id), instance.nodes(best_iterated_ls_solution))))
 
-    print_result(nodes, best_genetic_solution, best_genetic_result, 'Genetic')
+    print_result(instance, best_genetic_solution, best_genetic_result, 'Genetic')
     print('Genetic - best: {}, worst: {}, average: {}. Stop time: {}'.format(best_genetic_result, min(genetic_results), np.mean(genetic_results), stop_time))
-    print(list(map(lambda node: int(node.id), best_genetic_solution)))
+    print(list(map(lambda node: int(node.id), instance.nodes(best_genetic_solution))))
     
     
-def lab_3_results():
-    nodes = read_data("./data")
+def lab_3_results(racing=False, annealing_runs=10):
+    instance = read_data("./data")
+    if racing:
+        _, stop_time = multiple_start_local_search(instance)
+        configurations = {
+            'MultipleStart LS': lambda seed: multiple_start_local_search(instance, seed=seed)[0],
+            'Iterated LS': lambda seed: iterated_local_search(instance, stop_time),
+        }
+        for T0, alpha, L in itertools.product([50, 75, 100], [0.95, 0.98], [500, 1000]):
+            configurations['Simulated annealing, T0 {}, alpha {}, L {}'.format(T0, alpha, L)] = functools.partial(
+                lambda seed, **parameters: simulated_annealing(instance, **parameters)[:2], T0=T0, alpha=alpha, L=L)
+        race(configurations)
+        return
+
     multiple_start_times = []
     multiple_start_results = []
     best_multiple_start_solution = None
@@ -895,8 +1900,8 @@ def lab_3_results():
 
     for i in range(0, 10):
         print('MultipleStart LS')
-        solution, duration = multiple_start_local_search(nodes.copy())
-        if verify_solution(solution[0], solution[1]) > 1:
+        solution, duration = multiple_start_local_search(instance)
+        if verify_solution(instance, solution[0], solution[1]) > 1:
             raise ValueError("Node path verification failed")
         multiple_start_times.append(duration)
         multiple_start_results.append(solution[1])
@@ -909,18 +1914,25 @@ def lab_3_results():
 
     for i in range(0, 10):
         print('Iterated LS')
-        solution = iterated_local_search(nodes.copy(), stop_time)
-        if verify_solution(solution[0], solution[1]) > 1:
+        solution = iterated_local_search(instance, stop_time)
+        if verify_solution(instance, solution[0], solution[1]) > 1:
             raise ValueError("Node path verification failed")
         iterated_ls_results.append(solution[1])
         if best_iterated_ls_solution is None or solution[1] > best_iterated_ls_result:
             best_iterated_ls_solution = solution[0]
             best_iterated_ls_result = solution[1]
 
-    for i in range(0, 10):
+    if annealing_runs >= MULTI_CHAIN_MIN_CHAINS:
+        # one batched run of all chains, each chain is charged an equal share of its duration
+        print('Simulated annealing LS, {} batched chains'.format(annealing_runs))
+        chain_solutions, duration = multi_chain_simulated_annealing(instance, chains=annealing_runs)
+        annealing_solutions = [(tour, value, duration / annealing_runs) for tour, value in chain_solutions]
+    else:
+        annealing_solutions = (simulated_annealing(instance) for _ in range(annealing_runs))
+
+    for solution in annealing_solutions:
         print('Simulated annealing LS')
-        solution = simulated_annealing(nodes.copy())
-        if verify_solution(solution[0], solution[1]) > 1:
+        if verify_solution(instance, solution[0], solution[1]) > 1:
             raise ValueError("Node path verification failed")
         simulated_annealing_results.append(solution[1])
         simulated_annealing_times.append(solution[2])
@@ -928,91 +1940,263 @@ def lab_3_results():
             best_simulated_annealing_solution = solution[0]
             best_simulated_annealing_result = solution[1]
 
-    print_result(nodes, best_multiple_start_solution, best_multiple_start_result, 'MultipleStart LS')
+    print_result(instance, best_multiple_start_solution, best_multiple_start_result, 'MultipleStart LS')
     print('MultipleStart LS - best: {}, worst: {}, average: {}. Times: min {}, max {}, avg {}'.format(best_multiple_start_result, min(multiple_start_results), np.mean(multiple_start_results), min(multiple_start_times), max(multiple_start_times), np.mean(multiple_start_times)))
-    print(list(map(lambda node: int(node.id), best_multiple_start_solution)))
+    print(list(map(lambda node: int(node.id), instance.nodes(best_multiple_start_solution))))
 
-    print_result(nodes, best_iterated_ls_solution, best_iterated_ls_result, 'Iterated LS')
+    print_result(instance, best_iterated_ls_solution, best_iterated_ls_result, 'Iterated LS')
     print('Iterated LS - best: {}, worst: {}, average: {}. Stop time: {}'.format(best_iterated_ls_result, min(iterated_ls_results), np.mean(iterated_ls_results), stop_time))
-    print(list(map(lambda node: int(node.id), best_iterated_ls_solution)))
+    print(list(map(lambda node: int(node.id), instance.nodes(best_iterated_ls_solution))))
 
-    print_result(nodes, best_simulated_annealing_solution, best_simulated_annealing_result, 'Simulated annealing')
+    print_result(instance, best_simulated_annealing_solution, best_simulated_annealing_result, 'Simulated annealing')
     print('Simulated annealing - best: {}, worst: {}, average: {}. Times: min {}, max {}, avg {}'.format(best_simulated_annealing_result, min(simulated_annealing_results), np.mean(simulated_annealing_results), min(simulated_annealing_times), max(simulated_annealing_times), np.mean(simulated_annealing_times)))
-    print(list(map(lambda node: int(node.id), best_simulated_annealing_solution)))
-
-
-def lab_2_results():
-    nodes = read_data("./data")
-    best_nearest_neighbour_solution = None
-    best_nearest_neighbour_result = None
-    nearest_neighbour_times = []
-    nearest_neighbour_results = []
-    best_cycle_expansion_solution = None
-    best_cycle_expansion_result = None
-    cycle_expansion_times = []
-    cycle_expansion_results = []
-    best_cycle_expansion_with_regret_solution = None
-    best_cycle_expansion_with_regret_result = None
-    cycle_expansion_with_regret_times = []
-    cycle_expansion_with_regret_results = []
-    best_random_solution = None
-    best_random_result = None
-    random_times = []
-    random_results = []
-
-    for starting_index in range(0, len(nodes)):
-        print(starting_index)
-        print('NN')
-        solution = nearest_neighbour(nodes.copy(), starting_index)
-        locals_solution = enhance_solution_with_locals(solution[0], list(set(nodes.copy()) - set(solution[0])), solution[1])
-        nearest_neighbour_results.append(locals_solution[1])
-        nearest_neighbour_times.append(sum(locals_solution[2]))
-        if best_nearest_neighbour_solution is None or locals_solution[1] > best_nearest_neighbour_result:
-            best_nearest_neighbour_solution = locals_solution[0]
-            best_nearest_neighbour_result = locals_solution[1]
-
-        print('CE')
-        solution = cycle_expansion(nodes.copy(), starting_index)
-        locals_solution = enhance_solution_with_locals(solution[0], list(set(nodes.copy()) - set(solution[0])), solution[1])
-        cycle_expansion_results.append(locals_solution[1])
-        cycle_expansion_times.append(sum(locals_solution[2]))
-        if best_cycle_expansion_solution is None or locals_solution[1] > best_cycle_expansion_result:
-            best_cycle_expansion_solution = locals_solution[0]
-            best_cycle_expansion_result = locals_solution[1]
-
-        print('CE+R')
-        solution = cycle_expansion_with_regret(nodes.copy(), starting_index)
-        locals_solution = enhance_solution_with_locals(solution[0], list(set(nodes.copy()) - set(solution[0])), solution[1])
-        cycle_expansion_with_regret_results.append(locals_solution[1])
-        cycle_expansion_with_regret_times.append(sum(locals_solution[2]))
-        if best_cycle_expansion_with_regret_solution is None or locals_solution[1] > best_cycle_expansion_with_regret_result:
-            best_cycle_expansion_with_regret_solution = locals_solution[0]
-            best_cycle_expansion_with_regret_result = locals_solution[1]
-
-        print('RAND')
-        solution = generate_random_solution(nodes.copy())
-        locals_solution = enhance_solution_with_locals(solution[0], list(set(nodes.copy()) - set(solution[0])), solution[1])
-        random_results.append(locals_solution[1])
-        random_times.append(sum(locals_solution[2]))
-        if best_random_solution is None or locals_solution[1] > best_random_result:
-            best_random_solution = locals_solution[0]
-            best_random_result = locals_solution[1]
-
-    print_result(nodes, best_nearest_neighbour_solution, best_nearest_neighbour_result, 'Nearest neighbour')
-    print('Nearest neigbour - best: {}, worst: {}, average: {}. Times: min {}, max {}, avg {}'.format(best_nearest_neighbour_result, min(nearest_neighbour_results), np.mean(nearest_neighbour_results), min(nearest_neighbour_times), max(nearest_neighbour_times), np.mean(nearest_neighbour_times)))
-    print(list(map(lambda node: int(node.id), best_nearest_neighbour_solution)))
-    print_result(nodes, best_cycle_expansion_solution, best_cycle_expansion_result, 'Cycle expansion')
-    print('Cycle expansion - best: {}, worst: {}, average: {}. Times: min {}, max {}, avg {}'.format(best_cycle_expansion_result, min(cycle_expansion_results), np.mean(cycle_expansion_results), min(cycle_expansion_times), max(cycle_expansion_times), np.mean(cycle_expansion_times)))
-    print(list(map(lambda node: int(node.id), best_cycle_expansion_solution)))
-    print_result(nodes, best_cycle_expansion_with_regret_solution, best_cycle_expansion_with_regret_result, 'Cycle expansion with regret')
-    print('Cycle expansion with regret - best: {}, worst: {}, average: {}. Times: min {}, max {}, avg {}'.format(best_cycle_expansion_with_regret_result, min(cycle_expansion_with_regret_results), np.mean(cycle_expansion_with_regret_results), min(cycle_expansion_with_regret_times), max(cycle_expansion_with_regret_times), np.mean(cycle_expansion_with_regret_times)))
-    print(list(map(lambda node: int(node.id), best_cycle_expansion_with_regret_solution)))
-    print_result(nodes, best_cycle_expansion_with_regret_solution, best_cycle_expansion_with_regret_result,'Random')
-    print('Random - best: {}, worst: {}, average: {}. Times: min {}, max {}, avg {}'.format(best_random_result, min(random_results),np.mean(random_results), min(random_times),max(random_times), np.mean(random_times)))
-    print(list(map(lambda node: int(node.id), best_random_solution)))
+    print(list(map(lambda node: int(node.id), instance.nodes(best_simulated_annealing_solution))))
+
+
+def instance_hash(instance):
+    digest = hashlib.sha256()
+    for array in (instance.id, instance.x, instance.y, instance.gain):
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+def random_construction(instance, seed):
+    random.seed(seed)
+    return generate_random_solution(instance)
+
+
+# key, title and construction of every lab 2 algorithm; the random one is seeded per starting index instead
+LAB_2_ALGORITHMS = [
+    ("nn", "Nearest neighbour", nearest_neighbour),
+    ("ce", "Cycle expansion", cycle_expansion),
+    ("cer", "Cycle expansion with regret", cycle_expansion_with_regret),
+    ("random", "Random", random_construction),
+]
+
+
+def lab_2_task(instance, algorithm, argument, local_search=enhance_solution_with_locals):
+    construction = {key: construction for key, _, construction in LAB_2_ALGORITHMS}[algorithm]
+    solution = construction(instance, argument)
+    locals_solution = local_search(instance, solution[0], solution[1])
+    return locals_solution[0].astype(TOUR_DTYPE), locals_solution[1], sum(locals_solution[2])
+
+
+def lab_2_worker(algorithm, argument):
+    return lab_2_task(worker_state["instance"], algorithm, argument, worker_state["local_search"])
+
+
+def local_search_key(local_search):
+    # a partial is described by its function and bound arguments; the evaluation counter does not change results
+    if isinstance(local_search, functools.partial):
+        keywords = sorted((name, value) for name, value in local_search.keywords.items() if name != "counter")
+        return "{}{}{}".format(local_search_key(local_search.func), list(local_search.args), keywords)
+    return local_search.__name__
+
+
+def task_cache_path(cache_dir, instance_key, algorithm, argument, local_search):
+    key = "{}-{}-{}-{}-{}".format(instance_key, COST_WEIGHT, algorithm, argument, local_search_key(local_search))
+    return os.path.join(cache_dir, hashlib.sha256(key.encode()).hexdigest() + ".npz")
+
+
+def save_task_result(path, result):
+    # written under a temporary name and renamed, so an interrupted run never leaves a broken entry
+    temporary_path = path + ".tmp.npz"
+    np.savez(temporary_path, tour=result[0], value=result[1], time=result[2])
+    os.replace(temporary_path, path)
+
+
+def load_task_result(path):
+    with np.load(path) as data:
+        return data["tour"], data["value"][()], data["time"][()]
+
+
+def run_lab_2_tasks(instance, cache_dir="./cache", workers=None, seed=0, local_search=enhance_solution_with_locals):
+    # every (algorithm, starting index) result is stored on disk under a key of the instance, COST_WEIGHT,
+    # the algorithm, its argument and the local search, so only tasks missing from the cache are run
+    os.makedirs(cache_dir, exist_ok=True)
+    instance_key = instance_hash(instance)
+    random_seeds = start_seeds(seed, len(instance))
+    tasks = [(algorithm, random_seeds[index] if algorithm == "random" else index)
+             for algorithm, _, _ in LAB_2_ALGORITHMS for index in range(len(instance))]
+    paths = [task_cache_path(cache_dir, instance_key, algorithm, argument, local_search) for algorithm, argument in tasks]
+    # tasks and their paths are paired in one scan, so a cache entry written meanwhile by another run cannot shift them
+    missing = [(task, path) for task, path in zip(tasks, paths) if not os.path.exists(path)]
+    print("Lab 2 tasks: {} cached, {} to run".format(len(tasks) - len(missing), len(missing)))
+
+    if workers is None:
+        for (algorithm, argument), path in missing:
+            save_task_result(path, lab_2_task(instance, algorithm, argument, local_search))
+    elif missing:
+        with SharedInstance(instance) as shared_instance, \
+                ProcessPoolExecutor(workers, initializer=init_local_search_worker,
+                                    initargs=(shared_instance.handle, local_search)) as executor:
+            results = executor.map(lab_2_worker, *zip(*[task for task, _ in missing]))
+            for result, (_, path) in zip(results, missing):
+                save_task_result(path, result)
+
+    results = {algorithm: [] for algorithm, _, _ in LAB_2_ALGORITHMS}
+    for (algorithm, _), path in zip(tasks, paths):
+        results[algorithm].append(load_task_result(path))
+    return results
+
+
+LOCAL_SEARCHES = {
+    "steepest": enhance_solution_with_locals,
+    "move_list": enhance_solution_with_move_list,
+    "first_improvement": enhance_solution_first_improvement,
+}
+
+
+def grid_algorithm(algorithm):
+    # the solver of a grid algorithm and the spec parameters it takes; the grid supplies the instance,
+    # the seed and the evaluation counter, and every construction is followed by the chosen local search
+    constructions = {key: construction for key, _, construction in LAB_2_ALGORITHMS if key != "random"}
+    solvers = {"multiple_start_local_search": multiple_start_local_search,
+               "iterated_local_search": iterated_local_search,
+               "genetic_algorithm": genetic_algorithm,
+               "simulated_annealing": simulated_annealing}
+    solver = solvers.get(algorithm, constructions.get(algorithm))
+    if solver is None:
+        raise ValueError("Unknown algorithm: " + str(algorithm))
+    parameters = set(inspect.signature(solver).parameters) - {"instance", "seed", "counter", "checkpoint"}
+    if algorithm in constructions:
+        parameters.add("local_search")
+    return solver, parameters
+
+
+def run_grid_algorithm(instance, algorithm, parameters, seed):
+    # returns the tour, its value and the number of evaluated moves, None for solvers that do not count them
+    solver, accepted_parameters = grid_algorithm(algorithm)
+    unknown_parameters = sorted(set(parameters) - accepted_parameters)
+    if unknown_parameters:
+        raise ValueError("{} does not take {}".format(algorithm, ", ".join(unknown_parameters)))
+
+    random.seed(seed)
+    parameters = dict(parameters)
+    counter = EvaluationCounter()
+    local_search = functools.partial(LOCAL_SEARCHES[parameters.pop("local_search", "steepest")], counter=counter)
+
+    if algorithm == "multiple_start_local_search":
+        (tour, value), _ = solver(instance, local_search, seed=seed, **parameters)
+    elif algorithm == "iterated_local_search":
+        tour, value = solver(instance, counter=counter, **parameters)
+    elif algorithm == "genetic_algorithm":
+        tour, value = solver(instance, local_search=local_search, **parameters)
+    elif algorithm == "simulated_annealing":
+        tour, value, _ = solver(instance, **parameters)
+        return tour, value, None
+    else:
+        solution = solver(instance, **parameters)
+        tour, value, _ = local_search(instance, solution[0], solution[1])
+
+    return tour, value, counter.evaluations
+
+
+def init_grid_worker(instance_handles):
+    worker_state["instances"] = {path: attach_instance(handle) for path, handle in instance_handles.items()}
+
+
+def grid_worker(instance_path, algorithm, parameters, seed):
+    start = time.time()
+    tour, value, evaluations = run_grid_algorithm(worker_state["instances"][instance_path], algorithm, parameters, seed)
+    return np.asarray(tour, dtype=TOUR_DTYPE), float(value), time.time() - start, evaluations
+
+
+def experiment_cells(spec):
+    # every instance x experiment x parameter combination x repetition; a scalar parameter is a one-value list
+    for instance_path in spec["instances"]:
+        for experiment in spec["experiments"]:
+            parameters = experiment.get("parameters", {})
+            names = sorted(parameters)
+            values = [parameters[name] if isinstance(parameters[name], list) else [parameters[name]] for name in names]
+            for combination in itertools.product(*values):
+                for repetition in range(experiment.get("repetitions", 1)):
+                    yield instance_path, experiment["algorithm"], dict(zip(names, combination)), repetition
+
+
+def cell_key(instance_key, algorithm, parameters, repetition, seed):
+    cell = [instance_key, COST_WEIGHT, algorithm, parameters, repetition, seed]
+    return hashlib.sha256(json.dumps(cell, sort_keys=True).encode()).hexdigest()
+
+
+def open_results_database(path):
+    connection = sqlite3.connect(path)
+    connection.execute("CREATE TABLE IF NOT EXISTS runs (cell TEXT PRIMARY KEY, instance TEXT, algorithm TEXT, "
+                       "parameters TEXT, repetition INTEGER, seed INTEGER, objective REAL, tour BLOB, "
+                       "duration REAL, evaluations INTEGER)")
+    return connection
+
+
+def run_experiment_grid(spec_path):
+    # runs every cell of a JSON spec on a process pool and commits each finished run to SQLite,
+    # cells already in the database are skipped so an interrupted grid resumes where it stopped
+    with open(spec_path) as file:
+        spec = json.load(file)
+    connection = open_results_database(spec.get("database", "./experiments.sqlite"))
+    finished = {row[0] for row in connection.execute("SELECT cell FROM runs")}
+    instances = {path: read_data(path) for path in spec["instances"]}
+    instance_keys = {path: instance_hash(instance) for path, instance in instances.items()}
+
+    # experiments that expand to the same cell run it once
+    cells = []
+    seen = set(finished)
+    for instance_path, algorithm, parameters, repetition in experiment_cells(spec):
+        key = cell_key(instance_keys[instance_path], algorithm, parameters, repetition, spec.get("seed", 0))
+        if key not in seen:
+            seen.add(key)
+            cells.append((key, instance_path, algorithm, parameters, repetition, int(key[:8], 16)))
+    print("Experiment grid: {} finished, {} to run".format(len(finished), len(cells)))
+
+    # every instance is published once and attached by all workers
+    shared_instances = {path: SharedInstance(instance) for path, instance in instances.items()}
+    instance_handles = {path: shared_instance.handle for path, shared_instance in shared_instances.items()}
+    try:
+        run_grid_cells(connection, cells, spec.get("workers"), instance_handles)
+    finally:
+        for shared_instance in shared_instances.values():
+            shared_instance.close()
+        connection.close()
+
+
+def run_grid_cells(connection, cells, workers, instance_handles):
+    with ProcessPoolExecutor(workers, initializer=init_grid_worker, initargs=(instance_handles,)) as executor:
+        futures = {executor.submit(grid_worker, *cell[1:4], cell[5]): cell for cell in cells}
+        for future in as_completed(futures):
+            key, instance_path, algorithm, parameters, repetition, seed = futures[future]
+            try:
+                tour, value, duration, evaluations = future.result()
+            except Exception as error:
+                print("{} {} repetition {} failed: {!r}".format(algorithm, parameters, repetition, error))
+                continue
+            try:
+                connection.execute("INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                   (key, instance_path, algorithm, json.dumps(parameters, sort_keys=True), repetition,
+                                    seed, value, tour.tobytes(), duration, evaluations))
+                connection.commit()
+            except sqlite3.Error as error:
+                connection.rollback()
+                print("{} {} repetition {} not stored: {!r}".format(algorithm, parameters, repetition, error))
+                continue
+            print("{} {} repetition {}: {}".format(algorithm, parameters, repetition, value))
+
+
+def lab_2_results(workers=None, cache_dir="./cache", seed=0):
+    instance = read_data("./data")
+    results = run_lab_2_tasks(instance, cache_dir, workers, seed)
+
+    for algorithm, title, _ in LAB_2_ALGORITHMS:
+        tours, values, times = zip(*results[algorithm])
+        best = int(np.argmax(values))
+        print_result(instance, tours[best], values[best], title)
+        print('{} - best: {}, worst: {}, average: {}. Times: min {}, max {}, avg {}'.format(title, values[best], min(values), np.mean(values), min(times), max(times), np.mean(times)))
+        print(list(map(lambda node: int(node.id), instance.nodes(tours[best]))))
 
 
 def main():
+    if len(sys.argv) > 1:
+        run_experiment_grid(sys.argv[1])
+        return
+
     lab_5_results()
 
     # lab_4_results()
@@ -1022,4 +2206,5 @@ def main():
     # lab_2_results()
 
 
-main()
+if __name__ == "__main__":
+    main()